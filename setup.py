@@ -33,6 +33,11 @@ setup(
     package_dir={'tg_pubsub': 'tg_pubsub'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
+        'uvloop': ['uvloop'],
+    },
     dependency_links=[
         # We currently use our own fork, and also created a PR: https://github.com/aaugustin/websockets/pull/98
         'git+https://github.com/Jyrno42/websockets.git@18d26ea1d48ecadf6fc49d526a27814fb4b16362#egg=websockets-3.0',
@@ -46,7 +51,6 @@ setup(
         'License :: OSI Approved :: ISC License (ISCL)',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
     ],
 )
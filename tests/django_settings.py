@@ -17,6 +17,13 @@ STATICFILES_DIRS = (
 )
 
 
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
 INSTALLED_APPS = [
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -24,4 +31,6 @@ INSTALLED_APPS = [
 
     'rest_framework',
     'tg_pubsub',
+
+    'tests',
 ]
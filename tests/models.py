@@ -0,0 +1,13 @@
+from django.db import models
+
+from tg_pubsub.models import ListenableModelMixin
+
+
+class Pizza(ListenableModelMixin, models.Model):
+    name = models.CharField(max_length=100)
+    secret = models.CharField(max_length=100, blank=True)
+    owner = models.ForeignKey('auth.User', null=True, blank=True, on_delete=models.CASCADE)
+
+    serializer_fields = ('pk', 'name', 'owner')
+
+    pubsub_send_diff = True
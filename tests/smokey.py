@@ -4,12 +4,23 @@ def test_imports():
     """
     import tg_pubsub
 
+    from tg_pubsub import apps
+    from tg_pubsub import buffer
+    from tg_pubsub import cache
+    from tg_pubsub import codecs
     from tg_pubsub import config
     from tg_pubsub import exceptions
+    from tg_pubsub import executor
+    from tg_pubsub import heartbeat
     from tg_pubsub import messages
     from tg_pubsub import models
     from tg_pubsub import protocol
+    from tg_pubsub import outbound
+    from tg_pubsub import publisher
     from tg_pubsub import pubsub
+    from tg_pubsub import sessions
+    from tg_pubsub import subscriber
+    from tg_pubsub import supervisor
     from tg_pubsub import worker
 
     from tg_pubsub.management.commands.pubsub_server import Command
@@ -0,0 +1,89 @@
+from unittest import mock
+
+from tg_pubsub.buffer import TransactionBuffer
+
+
+class FakeMessage(object):
+    def __init__(self, klass, action, instance, changed_fields=None):
+        self.data = {'action': action}
+        self.instance = instance
+        self.changed_fields = changed_fields if action == 'saved' else None
+
+
+class FakeInstance(object):
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def add(buffer, action, instance, changed_fields=None):
+    with mock.patch('tg_pubsub.buffer.ModelChanged', FakeMessage):
+        buffer.add(FakeInstance, action, instance, changed_fields)
+
+
+def test_flush_never_raises():
+    buffer = TransactionBuffer('default')
+    add(buffer, 'saved', FakeInstance(1))
+
+    with mock.patch('tg_pubsub.buffer.publish_many', side_effect=ValueError('boom')) as publish_many:
+        buffer.flush()
+
+    assert publish_many.call_count == 1
+    assert not buffer.messages
+
+
+def test_created_then_saved_stays_created():
+    buffer = TransactionBuffer('default')
+    first, second = FakeInstance(1), FakeInstance(1)
+
+    add(buffer, 'created', first)
+    add(buffer, 'saved', second, {'name'})
+
+    messages = list(buffer.messages.values())
+
+    assert len(messages) == 1
+    assert messages[0].data['action'] == 'created'
+    assert messages[0].instance is second
+
+
+def test_created_then_deleted_is_dropped():
+    buffer = TransactionBuffer('default')
+
+    add(buffer, 'created', FakeInstance(1))
+    add(buffer, 'deleted', FakeInstance(1))
+
+    assert not buffer.messages
+
+
+def test_saves_merge_changed_fields():
+    buffer = TransactionBuffer('default')
+
+    add(buffer, 'saved', FakeInstance(1), {'pk', 'name'})
+    add(buffer, 'saved', FakeInstance(1), {'pk', 'email'})
+    add(buffer, 'saved', FakeInstance(2), {'pk', 'name'})
+
+    messages = list(buffer.messages.values())
+
+    assert len(messages) == 2
+    assert messages[0].changed_fields == {'pk', 'name', 'email'}
+    assert messages[1].changed_fields == {'pk', 'name'}
+
+
+def test_unknown_changes_win():
+    buffer = TransactionBuffer('default')
+
+    add(buffer, 'saved', FakeInstance(1), {'pk', 'name'})
+    add(buffer, 'saved', FakeInstance(1))
+
+    assert list(buffer.messages.values())[0].changed_fields is None
+
+
+def test_saved_then_deleted_is_deleted():
+    buffer = TransactionBuffer('default')
+
+    add(buffer, 'saved', FakeInstance(1), {'pk', 'name'})
+    add(buffer, 'deleted', FakeInstance(1))
+
+    messages = list(buffer.messages.values())
+
+    assert len(messages) == 1
+    assert messages[0].data['action'] == 'deleted'
@@ -0,0 +1,51 @@
+from tg_pubsub.cache import TTLCache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire():
+    timer = FakeTimer()
+    cache = TTLCache(10, 5, timer=timer)
+
+    cache.set('a', 1)
+    timer.now = 5
+    assert cache.get('a') == 1
+
+    timer.now = 5.1
+    assert cache.get('a') is None
+    assert cache.get('a', 'default') == 'default'
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(2, 60)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_delete_and_clear():
+    cache = TTLCache(2, 60)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.delete('a')
+    cache.delete('missing')
+
+    assert cache.get('a') is None
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
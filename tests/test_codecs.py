@@ -0,0 +1,92 @@
+import datetime
+import decimal
+import uuid
+
+import pytest
+
+from tg_pubsub.codecs import get_codec
+
+
+PAYLOAD = {
+    'model': 'app.Model',
+    'pk': 42,
+    'data': {
+        'name': 'Zażółć',
+        'price': decimal.Decimal('12.50'),
+        'created': datetime.datetime(2016, 3, 3, 12, 30, 15, 123456),
+        'day': datetime.date(2016, 3, 3),
+        'uuid': uuid.UUID('6f1c7d3e-3c2a-4b1e-9d4b-2f5e8a9c1b7d'),
+        'counts': {1: 'one', 2: 'two'},
+        'tags': ['a', 'b'],
+        'empty': None,
+    },
+}
+
+
+def test_json_codecs_match():
+    pytest.importorskip('orjson')
+
+    json_codec = get_codec('json')
+    orjson_codec = get_codec('orjson')
+
+    expected = json_codec.decode(json_codec.encode(PAYLOAD))
+
+    assert expected['data']['counts'] == {'1': 'one', '2': 'two'}
+    assert expected['data']['created'] == '2016-03-03T12:30:15.123456'
+    assert orjson_codec.decode(orjson_codec.encode(PAYLOAD)) == expected
+    assert json_codec.decode(orjson_codec.encode(PAYLOAD)) == expected
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip('msgpack')
+
+    json_codec = get_codec('json')
+    codec = get_codec('msgpack')
+
+    encoded = codec.encode(PAYLOAD)
+    assert isinstance(encoded, bytes)
+
+    decoded = codec.decode(encoded)
+    expected = json_codec.decode(json_codec.encode(PAYLOAD))
+
+    # msgpack keeps int keys
+    assert decoded['data'].pop('counts') == {1: 'one', 2: 'two'}
+    expected['data'].pop('counts')
+
+    assert decoded == expected
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson', 'msgpack'])
+def test_decode_invalid(name):
+    if name != 'json':
+        pytest.importorskip(name)
+
+    codec = get_codec(name)
+
+    try:
+        codec.decode(b'\xc1 not valid')
+
+    except ValueError:
+        pass
+
+    else:
+        assert False, '%s decoded invalid data' % name
+
+
+def test_msgpack_encode_batch():
+    pytest.importorskip('msgpack')
+
+    codec = get_codec('msgpack')
+
+    for count in (0, 1, 15, 16, 2 ** 16):
+        items = [{'pk': i} for i in range(count)]
+        frame = codec.encode_batch([codec.encode(item) for item in items])
+
+        assert codec.decode(frame) == items
+
+
+def test_json_encode_batch():
+    codec = get_codec('json')
+
+    items = [{'pk': 1}, {'pk': 2}]
+    assert codec.decode(codec.encode_batch([codec.encode(item) for item in items])) == items
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from tg_pubsub.heartbeat import Heartbeat
+
+
+class FakeConnection(object):
+    logging_key = 'fake'
+
+    def __init__(self, loop, alive=True):
+        self.loop = loop
+        self.alive = alive
+        self.pings = 0
+        self.closed = None
+
+    async def ping(self):
+        self.pings += 1
+        pong = self.loop.create_future()
+
+        if self.alive:
+            self.loop.call_soon(pong.set_result, None)
+
+        return pong
+
+    async def close(self, code, reason):
+        self.closed = code
+
+
+def run(loop, seconds):
+    loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def close(loop, heartbeat):
+    heartbeat.stop()
+
+    for ws in list(heartbeat.pings):
+        heartbeat.remove(ws)
+
+    # Let the cancelled pings finish
+    run(loop, 0)
+    loop.close()
+
+
+def test_dead_connections_are_closed():
+    loop = asyncio.new_event_loop()
+    heartbeat = Heartbeat(0.1, 4, loop=loop)
+
+    alive, dead = FakeConnection(loop), FakeConnection(loop, alive=False)
+    heartbeat.add(alive)
+    heartbeat.add(dead)
+
+    run(loop, 0.35)
+
+    assert alive.pings >= 2
+    assert alive.closed is None
+    assert dead.pings == 1
+    assert dead.closed == Heartbeat.DEAD_PEER_CLOSE_CODE
+    assert heartbeat.dead == 1
+    assert len(heartbeat) == 1
+
+    close(loop, heartbeat)
+
+
+def test_timer_idles_without_connections():
+    loop = asyncio.new_event_loop()
+    heartbeat = Heartbeat(0.1, 4, loop=loop)
+
+    ws = FakeConnection(loop)
+    heartbeat.add(ws)
+    heartbeat.remove(ws)
+
+    run(loop, 0.05)
+
+    assert heartbeat.handle is None
+    assert ws.pings == 0
+
+    close(loop, heartbeat)
+
+
+def test_missed_ticks_are_skipped():
+    loop = asyncio.new_event_loop()
+    heartbeat = Heartbeat(0.4, 4, loop=loop)
+
+    connections = [FakeConnection(loop) for i in range(20)]
+
+    for ws in connections:
+        heartbeat.add(ws)
+
+    ticks = []
+    run_tick = heartbeat.run_tick
+
+    def counting_run_tick():
+        ticks.append(loop.time())
+        run_tick()
+
+    heartbeat.run_tick = counting_run_tick
+    heartbeat.handle.cancel()
+    heartbeat.handle = loop.call_at(heartbeat.next_tick, heartbeat.run_tick)
+
+    # Block the loop for several ticks
+    loop.call_soon(time.sleep, 0.35)
+    run(loop, 0.4)
+
+    # The ticks missed while blocked do not run back to back
+    assert len(ticks) >= 2
+    assert min(b - a for a, b in zip(ticks, ticks[1:])) > 0.02
+
+    close(loop, heartbeat)
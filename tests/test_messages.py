@@ -0,0 +1,172 @@
+from unittest import mock
+
+import pytest
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import override_settings
+from django.utils.functional import SimpleLazyObject
+
+from tg_pubsub.exceptions import InvalidMessageException
+from tg_pubsub.messages import ModelChanged, decode_message
+
+from .models import Pizza
+
+
+def create_message(data):
+    # Skips the model specific parts of __init__
+    message = ModelChanged.__new__(ModelChanged)
+    message.channels = ['django']
+    message.data = data
+
+    return message
+
+
+@override_settings(TG_PUBSUB_EMBED_MAX_SIZE=200)
+def test_embedded_data_size_limit():
+    data = {'app': 'app', 'model': 'Model', 'action': 'saved', 'pk': 1}
+
+    small = create_message(dict(data, data={'pk': 1, 'name': 'small'}))
+    assert '"name": "small"' in small.as_message()
+    assert 'data' in small.data
+
+    large = create_message(dict(data, data={'pk': 1, 'name': 'x' * 200}))
+    assert 'name' not in large.as_message()
+    assert 'data' not in large.data
+
+
+def test_decode_message():
+    message = decode_message({'data': b'model:{"app": "app", "model": "Model", "action": "saved", "pk": 1}'})
+
+    assert message.message_class is ModelChanged
+    assert message.data['pk'] == 1
+
+
+def test_decode_message_errors():
+    invalid = [
+        b'',
+        b'model',
+        b'model:',
+        b':{"pk": 1}',
+        b'unknown:{"pk": 1}',
+        b'model:{not json',
+        'ümodel:{"pk": 1}',
+    ]
+
+    for data in invalid:
+        try:
+            decode_message({'data': data})
+
+        except InvalidMessageException:
+            pass
+
+        else:
+            assert False, 'Decoded invalid message %r' % data
+
+
+class FakeConnection(object):
+    def __init__(self, user):
+        self.user = user
+
+
+def lazy_user(pk):
+    # Like the request.user of the pubsub server
+    return SimpleLazyObject(lambda: User.objects.get(pk=pk))
+
+
+def create_pizza(**kwargs):
+    with mock.patch('tg_pubsub.messages.pubsub.publish_many'):
+        pizza = Pizza.objects.create(**kwargs)
+
+    return pizza, {'app': 'tests', 'model': 'Pizza', 'action': 'saved', 'pk': pizza.pk}
+
+
+@pytest.mark.django_db
+def test_prepare_for_send_bulk_checks_users_once():
+    first, second = User.objects.create(username='first'), User.objects.create(username='second')
+    pizza, data = create_pizza(name='Margherita', owner=first)
+
+    recipients = [
+        FakeConnection(lazy_user(first.pk)),
+        FakeConnection(lazy_user(second.pk)),
+        FakeConnection(lazy_user(first.pk)),
+        FakeConnection(AnonymousUser()),
+        FakeConnection(AnonymousUser()),
+    ]
+
+    checked = []
+
+    def has_access(cls, instance, user):
+        checked.append(user)
+        return user.pk != second.pk
+
+    with mock.patch.object(Pizza, 'has_access', classmethod(has_access)):
+        prepared = ModelChanged.prepare_for_send_bulk(recipients, data)
+
+    # One check per distinct user, the anonymous users are the same user too
+    assert sorted(user.pk or 0 for user in checked) == [0, first.pk, second.pk]
+
+    assert [ws for ws, payload in prepared] == [recipients[0], recipients[2], recipients[3], recipients[4]]
+
+    # Everyone shares the same payload
+    assert len(set(id(payload) for ws, payload in prepared)) == 1
+    assert prepared[0][1] == {
+        'model': 'tests.Pizza',
+        'action': 'saved',
+        'pk': pizza.pk,
+        'data': {'pk': pizza.pk, 'name': 'Margherita', 'owner': first.pk},
+    }
+
+
+@pytest.mark.django_db
+def test_has_access_bulk_returning_instances():
+    first, second = User.objects.create(username='first'), User.objects.create(username='second')
+    pizza, data = create_pizza(name='Margherita', owner=first)
+
+    recipients = [
+        FakeConnection(lazy_user(first.pk)),
+        FakeConnection(lazy_user(second.pk)),
+        FakeConnection(AnonymousUser()),
+    ]
+
+    # Users fetched from the database are not the objects given in, but compare equal to them
+    def has_access_bulk(cls, instance, users):
+        return list(User.objects.filter(pk=instance.owner_id))
+
+    with mock.patch.object(Pizza, 'has_access_bulk', classmethod(has_access_bulk)):
+        prepared = ModelChanged.prepare_for_send_bulk(recipients, data)
+
+    assert [ws for ws, payload in prepared] == [recipients[0]]
+
+    def has_access_bulk_queryset(cls, instance, users):
+        return User.objects.filter(pk__in=[user.pk for user in users if user.pk])
+
+    with mock.patch.object(Pizza, 'has_access_bulk', classmethod(has_access_bulk_queryset)):
+        prepared = ModelChanged.prepare_for_send_bulk(recipients, data)
+
+    assert [ws for ws, payload in prepared] == [recipients[0], recipients[1]]
+
+
+@pytest.mark.django_db
+def test_deleted_instance_is_gone():
+    recipients = [FakeConnection(AnonymousUser())]
+    data = {'app': 'tests', 'model': 'Pizza', 'action': 'deleted', 'pk': 1}
+
+    assert ModelChanged.prepare_for_send_bulk(recipients, data) == []
+
+    # Embedded data is not enough, the access checks need the instance
+    with mock.patch.object(Pizza, 'pubsub_embed_data', True):
+        assert ModelChanged.prepare_for_send_bulk(recipients, dict(data, data={'pk': 1, 'name': 'Marinara'})) == []
+
+    with mock.patch.object(Pizza, 'pubsub_embed_access', True):
+        prepared = ModelChanged.prepare_for_send_bulk(recipients, dict(data, data={'pk': 1, 'name': 'Marinara'}))
+
+    assert prepared == [(recipients[0], {
+        'model': 'tests.Pizza',
+        'action': 'deleted',
+        'pk': 1,
+        'data': {'pk': 1, 'name': 'Marinara'},
+    })]
+
+    # Other missing instances are still errors
+    with pytest.raises(Pizza.DoesNotExist):
+        ModelChanged.prepare_for_send_bulk(recipients, dict(data, action='saved'))
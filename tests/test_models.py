@@ -0,0 +1,172 @@
+from unittest import mock
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from tg_pubsub.messages import ModelChanged, decode_message
+
+from .models import Pizza
+
+
+class Published(object):
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, items):
+        # Every channel gets the same message
+        self.messages.append(decode_message({'data': list(items)[0][1]}).data)
+
+    @property
+    def last(self):
+        return self.messages[-1]
+
+
+@pytest.fixture
+def published(request):
+    published = Published()
+
+    patcher = mock.patch('tg_pubsub.messages.pubsub.publish_many', published)
+    patcher.start()
+    request.addfinalizer(patcher.stop)
+
+    return published
+
+
+@pytest.mark.django_db
+def test_created_and_deleted_are_not_diffed(published):
+    pizza = Pizza.objects.create(name='Margherita')
+
+    assert published.last['action'] == 'created'
+    assert 'changed' not in published.last
+
+    pk = pizza.pk
+    pizza.delete()
+
+    assert published.last['action'] == 'deleted'
+    assert published.last['pk'] == pk
+    assert 'changed' not in published.last
+
+
+@pytest.mark.django_db
+def test_changed_fields(published):
+    pizza = Pizza.objects.create(name='Margherita')
+    pizza = Pizza.objects.get(pk=pizza.pk)
+
+    pizza.name = 'Marinara'
+    pizza.save()
+
+    assert published.last['action'] == 'saved'
+    assert published.last['changed'] == ['id', 'name']
+
+
+@pytest.mark.django_db
+def test_update_fields_are_used_as_is(published):
+    pizza = Pizza.objects.create(name='Margherita')
+
+    # Not actually changed, but update_fields is trusted without comparing values
+    pizza.save(update_fields=['secret'])
+
+    assert published.last['changed'] == ['id', 'secret']
+
+
+@pytest.mark.django_db
+def test_foreign_key_name_and_attname(published):
+    user = User.objects.create(username='chef')
+    pizza = Pizza.objects.create(name='Margherita')
+    pizza = Pizza.objects.get(pk=pizza.pk)
+
+    pizza.owner = user
+    pizza.save()
+
+    assert published.last['changed'] == ['id', 'owner', 'owner_id']
+
+    pizza.save(update_fields=['owner_id'])
+
+    assert published.last['changed'] == ['id', 'owner', 'owner_id']
+
+    payload = ModelChanged.prepare_shared(published.last)[2]
+
+    assert payload['partial']
+    assert payload['data'] == {'pk': pizza.pk, 'owner': user.pk}
+
+
+@pytest.mark.django_db
+def test_deferred_fields_are_not_fetched(published):
+    pizza = Pizza.objects.create(name='Margherita', secret='basil')
+    pizza = Pizza.objects.only('name').get(pk=pizza.pk)
+
+    pizza.name = 'Marinara'
+
+    with CaptureQueriesContext(connection) as queries:
+        pizza.save()
+
+    # Just the update, the deferred secret is not loaded for the diff
+    assert len(queries) == 1
+    assert 'secret' not in pizza.__dict__
+
+    assert published.last['changed'] == ['id', 'name']
+
+
+@pytest.mark.django_db
+def test_state_is_refreshed_after_save(published):
+    pizza = Pizza.objects.create(name='Margherita')
+
+    pizza.name = 'Marinara'
+    pizza.save()
+
+    assert published.last['changed'] == ['id', 'name']
+
+    pizza.secret = 'basil'
+    pizza.save()
+
+    # The name change was already published
+    assert published.last['changed'] == ['id', 'secret']
+
+    # Changes of fields that are not serialized still publish an update, with just the pk
+    payload = ModelChanged.prepare_shared(published.last)[2]
+
+    assert payload['partial']
+    assert payload['data'] == {'pk': pizza.pk}
+
+    pizza.save()
+
+    assert published.last['changed'] == ['id']
+
+
+def test_filter_changed():
+    serialized = {'pk': 1, 'name': 'Marinara', 'owner': 2}
+
+    assert ModelChanged.filter_changed(serialized, {'id', 'name'}) == {'pk': 1, 'name': 'Marinara'}
+    assert ModelChanged.filter_changed(serialized, {'id', 'owner', 'owner_id'}) == {'pk': 1, 'owner': 2}
+    assert ModelChanged.filter_changed(serialized, {'id', 'secret'}) == {'pk': 1}
+
+    # Custom serializers may return anything
+    assert ModelChanged.filter_changed([1, 2], {'id'}) == [1, 2]
+
+
+@pytest.mark.django_db
+def test_deferred_class_signals(published):
+    # Django < 1.10 creates a proxy subclass for instances with deferred fields and sends their signals with it
+    class Meta:
+        proxy = True
+        app_label = 'tests'
+
+    deferred = type('Pizza_Deferred_secret', (Pizza, ), {'Meta': Meta, '_deferred': True, '__module__': __name__})
+
+    pizza = Pizza.objects.create(name='Margherita')
+    pizza = deferred.objects.get(pk=pizza.pk)
+
+    pizza.name = 'Marinara'
+    pizza.save()
+
+    assert published.last['model'] == 'Pizza'
+    assert published.last['action'] == 'saved'
+    assert published.last['changed'] == ['id', 'name']
+
+    pizza.delete()
+
+    assert published.last['model'] == 'Pizza'
+    assert published.last['action'] == 'deleted'
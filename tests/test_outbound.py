@@ -0,0 +1,81 @@
+import asyncio
+
+from tg_pubsub.outbound import OutboundQueue
+
+
+def test_coalesced_frame_moves_to_the_end():
+    queue = OutboundQueue()
+
+    queue.put('full-1', key='app.Model:1')
+    queue.put('partial-1')
+    queue.put('full-2', key='app.Model:1')
+
+    assert len(queue) == 2
+    assert queue.coalesced == 1
+    assert queue.get_many(10) == ['partial-1', 'full-2']
+    assert not queue.keys
+
+
+def test_replaced_entries_are_compacted():
+    queue = OutboundQueue()
+
+    queue.put('other')
+
+    for i in range(100):
+        queue.put('full-%d' % i, key='app.Model:1')
+
+    assert len(queue) == 2
+    assert len(queue.entries) <= 5
+    assert queue.get_many(10) == ['other', 'full-99']
+
+
+def test_drop_oldest():
+    queue = OutboundQueue(2, OutboundQueue.POLICY_DROP_OLDEST)
+
+    for frame in ('a', 'b', 'c'):
+        queue.put(frame)
+
+    assert queue.dropped == 1
+    assert queue.max_depth == 2
+    assert queue.get_many(10) == ['b', 'c']
+
+
+def test_coalesce_policy_keeps_accepting_replacements():
+    queue = OutboundQueue(2, OutboundQueue.POLICY_COALESCE)
+
+    queue.put('a', key='app.Model:1')
+    queue.put('b')
+    queue.put('c')
+    queue.put('a2', key='app.Model:1')
+
+    assert queue.dropped == 1
+    assert queue.coalesced == 1
+    assert queue.get_many(10) == ['b', 'a2']
+
+
+def test_disconnect_policy_closes_queue():
+    queue = OutboundQueue(2, OutboundQueue.POLICY_DISCONNECT)
+
+    for frame in ('a', 'b', 'c'):
+        queue.put(frame)
+
+    assert queue.overflowed
+    assert queue.closed
+    assert queue.dropped == 3
+    assert len(queue) == 0
+
+    queue.put('d')
+    assert len(queue) == 0
+
+
+def test_get_waits_for_frames():
+    loop = asyncio.new_event_loop()
+    queue = OutboundQueue()
+
+    loop.call_later(0.01, queue.put, 'a')
+    assert loop.run_until_complete(queue.get()) == 'a'
+
+    loop.call_later(0.01, queue.close)
+    assert loop.run_until_complete(queue.get()) is None
+
+    loop.close()
@@ -0,0 +1,122 @@
+import threading
+
+from tg_pubsub.publisher import BackgroundPublisher
+
+
+class Sender(object):
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, items):
+        self.sent.extend(items)
+
+
+def create_publisher(maxsize=2, batch_size=100, overflow=BackgroundPublisher.OVERFLOW_DROP, send=None):
+    return BackgroundPublisher(send or Sender(), maxsize, batch_size, overflow)
+
+
+def test_drop():
+    publisher = create_publisher(overflow=BackgroundPublisher.OVERFLOW_DROP)
+
+    # Holding the lock keeps the thread from draining the queue
+    with publisher.condition:
+        for name in ('a', 'b', 'c'):
+            publisher.put([(name, name)])
+
+        assert list(publisher.queue) == [[('a', 'a')], [('b', 'b')]]
+        assert publisher.dropped == 1
+
+    publisher.stop()
+    assert publisher.send.sent == [('a', 'a'), ('b', 'b')]
+
+
+def test_drop_oldest():
+    publisher = create_publisher(overflow=BackgroundPublisher.OVERFLOW_DROP_OLDEST)
+
+    with publisher.condition:
+        for name in ('a', 'b', 'c'):
+            publisher.put([(name, name)])
+
+        assert list(publisher.queue) == [[('b', 'b')], [('c', 'c')]]
+        assert publisher.dropped == 1
+
+    publisher.stop()
+    assert publisher.send.sent == [('b', 'b'), ('c', 'c')]
+
+
+class BlockingSender(Sender):
+    def __init__(self):
+        super().__init__()
+
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, items):
+        self.sending.set()
+        self.release.wait(5)
+
+        super().__call__(items)
+
+
+def test_block():
+    send = BlockingSender()
+    publisher = create_publisher(maxsize=1, overflow=BackgroundPublisher.OVERFLOW_BLOCK, send=send)
+
+    # Taken by the thread, which then blocks in send
+    publisher.put([('a', 'a')])
+    assert send.sending.wait(5)
+
+    publisher.put([('b', 'b')])
+
+    blocked = threading.Thread(target=publisher.put, args=([('c', 'c')],))
+    blocked.start()
+    blocked.join(0.05)
+
+    assert blocked.is_alive()
+    assert list(publisher.queue) == [[('b', 'b')]]
+
+    send.release.set()
+    blocked.join(5)
+
+    assert not blocked.is_alive()
+
+    publisher.stop()
+    assert send.sent == [('a', 'a'), ('b', 'b'), ('c', 'c')]
+    assert publisher.dropped == 0
+
+
+def test_take_batch():
+    publisher = create_publisher(maxsize=10, batch_size=2)
+
+    with publisher.condition:
+        for name in ('a', 'b', 'c', 'd', 'e'):
+            publisher.put([(name, name)])
+
+        publisher.put([('f', 'f1'), ('f', 'f2')])
+
+        assert publisher.take_batch() == [('a', 'a'), ('b', 'b')]
+        assert publisher.take_batch() == [('c', 'c'), ('d', 'd')]
+
+        # Channels of a single message are never split over batches
+        assert publisher.take_batch() == [('e', 'e'), ('f', 'f1'), ('f', 'f2')]
+
+    publisher.stop()
+
+
+def test_stop_flushes_queue():
+    publisher = create_publisher(maxsize=10)
+
+    with publisher.condition:
+        for name in ('a', 'b', 'c'):
+            publisher.put([(name, name)])
+
+    publisher.stop()
+
+    assert not publisher.thread.is_alive()
+    assert publisher.send.sent == [('a', 'a'), ('b', 'b'), ('c', 'c')]
+
+    # Sent synchronously once stopped
+    publisher.put([('d', 'd')])
+
+    assert publisher.send.sent[-1] == ('d', 'd')
+    assert publisher.dropped == 0
@@ -0,0 +1,22 @@
+from tg_pubsub.pubsub import Backoff
+
+
+def test_backoff():
+    backoff = Backoff(base=0.5, maximum=3)
+
+    assert backoff.available
+    assert backoff.delay == 0.5
+
+    delays = []
+
+    for i in range(5):
+        backoff.failed()
+        delays.append(backoff.delay)
+
+    assert delays == [0.5, 1, 2, 3, 3]
+    assert not backoff.available
+
+    backoff.succeeded()
+
+    assert backoff.available
+    assert backoff.delay == 0.5
@@ -0,0 +1,151 @@
+from unittest import mock
+
+import pytest
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends import cache as cache_session_engine
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.test import override_settings
+
+from tg_pubsub.cache import TTLCache
+from tg_pubsub.messages import SessionInvalidated, decode_message
+from tg_pubsub.sessions import get_cache_key, get_cached_user, get_session_model, invalidate_session
+
+
+class Request(object):
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+
+class FakeUser(object):
+    def __init__(self, authenticated):
+        self.authenticated = authenticated
+
+    def is_authenticated(self):
+        return self.authenticated
+
+
+def create_session():
+    session = SessionStore()
+    session['data'] = 'value'
+    session.save()
+
+    return session.session_key
+
+
+@pytest.fixture
+def caches(request):
+    caches = {
+        'user_cache': TTLCache(10, 60),
+        'invalid_session_cache': TTLCache(10, 60),
+    }
+
+    for name, cache in caches.items():
+        patcher = mock.patch('tg_pubsub.sessions.%s' % name, cache)
+        patcher.start()
+        request.addfinalizer(patcher.stop)
+
+    return caches
+
+
+@pytest.fixture
+def published(request):
+    published = []
+
+    patcher = mock.patch('tg_pubsub.messages.pubsub.publish_many', lambda items: published.extend(items))
+    patcher.start()
+    request.addfinalizer(patcher.stop)
+
+    return published
+
+
+@override_settings(TG_PUBSUB_USER_CACHE_TTL=60)
+def test_cached_user(caches):
+    user = FakeUser(True)
+
+    with mock.patch('django.contrib.auth.middleware.get_user', return_value=user) as get_user:
+        assert get_cached_user(Request('session')) is user
+        assert get_cached_user(Request('session')) is user
+
+    assert get_user.call_count == 1
+    assert caches['user_cache'].get(get_cache_key('session')) is user
+
+
+@override_settings(TG_PUBSUB_USER_CACHE_TTL=60)
+def test_invalid_sessions_are_cached(caches):
+    with mock.patch('django.contrib.auth.middleware.get_user', return_value=FakeUser(False)) as get_user:
+        assert not get_cached_user(Request('invalid')).is_authenticated()
+        assert isinstance(get_cached_user(Request('invalid')), AnonymousUser)
+
+    # The session store is only hit once
+    assert get_user.call_count == 1
+
+    assert caches['invalid_session_cache'].get(get_cache_key('invalid'))
+    assert len(caches['user_cache']) == 0
+
+
+@override_settings(TG_PUBSUB_USER_CACHE_TTL=0)
+def test_no_cache():
+    with mock.patch('django.contrib.auth.middleware.get_user', return_value=FakeUser(True)) as get_user:
+        get_cached_user(Request('session'))
+        get_cached_user(Request('session'))
+
+    assert get_user.call_count == 2
+    assert isinstance(get_cached_user(Request('')), AnonymousUser)
+
+
+def test_session_invalidated_round_trip(caches, published):
+    key = get_cache_key('session')
+
+    caches['user_cache'].set(key, 'user')
+    caches['invalid_session_cache'].set(key, True)
+
+    # The cache of this process is invalidated right away, other processes via redis
+    invalidate_session('session')
+
+    assert len(caches['user_cache']) == 0
+    assert len(caches['invalid_session_cache']) == 0
+
+    caches['user_cache'].set(key, 'user')
+
+    channel, data = published[0]
+    message = decode_message({'data': data})
+
+    assert channel == 'django'
+    assert message.message_class is SessionInvalidated
+    assert message.data == {'key': key}
+
+    message.message_class.handle_on_server(message.data)
+
+    assert len(caches['user_cache']) == 0
+
+
+@override_settings(TG_PUBSUB_USER_CACHE_TTL=0)
+def test_invalidated_without_local_cache(published):
+    # The web process might not have a cache ttl, the pubsub server can
+    invalidate_session('session')
+
+    assert published
+
+
+def test_session_model():
+    assert get_session_model() is Session
+
+    with mock.patch('tg_pubsub.sessions.session_engine', cache_session_engine):
+        assert get_session_model() is None
+
+
+@pytest.mark.django_db
+def test_deleting_session_invalidates(published):
+    session_key = create_session()
+
+    SessionStore(session_key).delete()
+
+    assert len(published) == 1
+    assert decode_message({'data': published[0][1]}).data == {'key': get_cache_key(session_key)}
+
+    create_session()
+    Session.objects.all().delete()
+
+    assert len(published) == 2
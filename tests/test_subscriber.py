@@ -0,0 +1,220 @@
+import asyncio
+import threading
+
+from django.test import override_settings
+
+from tg_pubsub.codecs import JSONCodec
+from tg_pubsub.messages import BaseMessage, DecodedMessage, ModelChanged
+from tg_pubsub.subscriber import Subscriber
+
+
+def create_subscriber():
+    subscriber = Subscriber(loop=asyncio.new_event_loop())
+    subscriber.started = True
+
+    return subscriber
+
+
+def test_valid_channels():
+    assert Subscriber.is_valid_channel('app.Model')
+    assert Subscriber.is_valid_channel('app.Model:42')
+    assert Subscriber.is_valid_channel('app.Model:6f1c7d3e-3c2a-4b1e-9d4b-2f5e8a9c1b7d')
+
+    assert not Subscriber.is_valid_channel('')
+    assert not Subscriber.is_valid_channel('app')
+    assert not Subscriber.is_valid_channel('app.Model:42\n')
+    assert not Subscriber.is_valid_channel('app.Model:42:extra')
+    assert not Subscriber.is_valid_channel('app.%s' % ('x' * Subscriber.MAX_CHANNEL_LENGTH))
+
+
+@override_settings(TG_PUBSUB_MAX_CHANNELS=2)
+def test_subscribe_limits():
+    subscriber = create_subscriber()
+    ws = object()
+    subscriber.register(ws)
+
+    subscriber.subscribe(ws, ['not a channel'])
+    assert ws in subscriber.firehose
+    assert not subscriber.subscriptions[ws]
+
+    subscriber.subscribe(ws, ['app.Model', 'app.Model:1', 'app.Model:2'])
+    assert ws not in subscriber.firehose
+    assert subscriber.subscriptions[ws] == {'app.Model', 'app.Model:1'}
+    assert set(subscriber.channel_index) == {'app.Model', 'app.Model:1'}
+
+
+class FakePubSub(object):
+    connection = None
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def get_message(self):
+        if not self.messages:
+            return None
+
+        return self.messages.pop(0)
+
+
+@override_settings(TG_PUBSUB_MAX_PENDING_MESSAGES=2)
+def test_reading_pauses_while_pending_is_full():
+    subscriber = create_subscriber()
+    messages = [
+        {'type': 'message', 'data': 'model:{"app": "app", "model": "Model", "action": "saved", "pk": %d}' % pk}
+        for pk in range(5)
+    ]
+    subscriber.pubsub = FakePubSub(list(messages))
+
+    subscriber.read()
+
+    assert subscriber.paused
+    assert subscriber.pending.qsize() == 2
+    assert len(subscriber.pubsub.messages) == 3
+
+    loop = subscriber.loop
+    deliver = loop.create_task(subscriber.deliver())
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert not subscriber.paused
+    assert not subscriber.pubsub.messages
+    assert subscriber.pending.empty()
+
+    deliver.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+class ExecutorMessage(BaseMessage):
+    prepare_in_executor = True
+
+    threads = []
+
+    @classmethod
+    def prepare_for_send_bulk(cls, recipients, data):
+        cls.threads.append(threading.current_thread())
+
+        return [(ws, data) for ws in recipients]
+
+
+@override_settings(TG_PUBSUB_DB_WORKERS=2)
+def test_prepare_in_executor():
+    subscriber = create_subscriber()
+    first, second = object(), object()
+
+    subscriber.register(first)
+    subscriber.register(second)
+
+    message = DecodedMessage(ExecutorMessage, {'pk': 1})
+    prepared = subscriber.loop.run_until_complete(subscriber.prepare(message))
+
+    assert set(ws for ws, data in prepared) == {first, second}
+
+    # Prepared once for all recipients, off the event loop
+    assert len(ExecutorMessage.threads) == 1
+    assert ExecutorMessage.threads[0] is not threading.current_thread()
+
+    # Nothing to prepare without recipients
+    subscriber.unregister(first)
+    subscriber.unregister(second)
+
+    assert subscriber.loop.run_until_complete(subscriber.prepare(message)) == []
+    assert len(ExecutorMessage.threads) == 1
+
+    subscriber.loop.close()
+
+
+def model_message(model, pk, action='saved'):
+    app, model = model.split('.')
+
+    return DecodedMessage(ModelChanged, {'app': app, 'model': model, 'action': action, 'pk': pk})
+
+
+def test_get_recipients():
+    subscriber = create_subscriber()
+    firehose, model, instance, other = object(), object(), object(), object()
+
+    for ws in (firehose, model, instance, other):
+        subscriber.register(ws)
+
+    subscriber.subscribe(model, ['app.Model'])
+    subscriber.subscribe(instance, ['app.Model:1', 'app.Other:2'])
+    subscriber.subscribe(other, ['app.Other'])
+
+    assert set(subscriber.get_recipients(model_message('app.Model', 1))) == {firehose, model, instance}
+    assert set(subscriber.get_recipients(model_message('app.Model', 2))) == {firehose, model}
+    assert set(subscriber.get_recipients(model_message('app.Other', 2))) == {firehose, instance, other}
+    assert set(subscriber.get_recipients(model_message('app.Unknown', 1))) == {firehose}
+
+    # Messages without routing keys go to everyone
+    assert set(subscriber.get_recipients(DecodedMessage(BaseMessage, {}))) == {firehose, model, instance, other}
+
+
+def test_unsubscribe():
+    subscriber = create_subscriber()
+    ws = object()
+
+    subscriber.register(ws)
+    subscriber.subscribe(ws, ['app.Model', 'app.Model:1'])
+    subscriber.unsubscribe(ws, ['app.Model', 'app.Unknown'])
+
+    assert subscriber.get_recipients(model_message('app.Model', 1)) == [ws]
+    assert subscriber.get_recipients(model_message('app.Model', 2)) == []
+    assert set(subscriber.channel_index) == {'app.Model:1'}
+
+    # Unsubscribing from everything does not put the connection back into the firehose
+    subscriber.unsubscribe(ws, ['app.Model:1'])
+
+    assert subscriber.get_recipients(model_message('app.Model', 1)) == []
+    assert subscriber.channel_index == {}
+
+    subscriber.subscribe(ws, ['app.Model'])
+    subscriber.unregister(ws)
+
+    assert subscriber.channel_index == {}
+    assert subscriber.get_recipients(model_message('app.Model', 1)) == []
+
+
+class CountingCodec(JSONCodec):
+    def __init__(self, name):
+        self.name = name
+        self.encoded = []
+
+    def encode(self, data):
+        self.encoded.append(data)
+
+        return super().encode(data)
+
+
+class FakeConnection(object):
+    def __init__(self, codec):
+        self.codec = codec
+
+
+def test_broadcast_encodes_once():
+    subscriber = create_subscriber()
+    json, other = CountingCodec('json'), CountingCodec('other')
+
+    connections = [FakeConnection(json) for i in range(3)] + [FakeConnection(other) for i in range(2)]
+    queues = [subscriber.register(ws) for ws in connections]
+
+    shared = {'pk': 1}
+    custom = {'pk': 1, 'custom': True}
+
+    prepared = [(ws, shared) for ws in connections[:-1]] + [(connections[-1], custom)]
+    subscriber.broadcast(model_message('app.Model', 1), prepared)
+
+    # One encode per distinct payload and codec
+    assert json.encoded == [shared]
+    assert other.encoded == [shared, custom]
+
+    frames = [queue.get_many(10) for queue in queues]
+
+    assert frames[:4] == [['{"pk": 1}']] * 4
+    assert frames[0][0] is frames[1][0] is frames[2][0]
+    assert frames[4] == ['{"pk": 1, "custom": true}']
+
+    # Already encoded data is queued as is
+    subscriber.broadcast(model_message('app.Model', 1), [(connections[0], 'frame')])
+
+    assert queues[0].get_many(10) == ['frame']
+    assert len(json.encoded) == 1
@@ -0,0 +1,87 @@
+import socket
+import time
+
+from tg_pubsub.supervisor import Supervisor
+
+
+def test_bind_all_interfaces():
+    supervisor = Supervisor('', 0, 2, 'asyncio')
+    sockets = supervisor.bind()
+
+    try:
+        assert sockets
+
+        for sock in sockets:
+            assert sock.getsockname()[1] != 0
+            assert sock.type == socket.SOCK_STREAM
+
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def test_bind_address():
+    supervisor = Supervisor('127.0.0.1', 0, 2, 'asyncio')
+    sockets = supervisor.bind()
+
+    try:
+        assert len(sockets) == 1
+        assert sockets[0].getsockname()[0] == '127.0.0.1'
+
+        # Listening, so connecting works
+        client = socket.create_connection(sockets[0].getsockname()[:2])
+        client.close()
+
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+class FakeSupervisor(Supervisor):
+    def __init__(self):
+        super().__init__('127.0.0.1', 0, 2, 'asyncio')
+
+        self.spawned = 0
+
+    def spawn(self):
+        self.spawned += 1
+
+
+def test_restart_worker(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('tg_pubsub.supervisor.time.sleep', sleeps.append)
+
+    supervisor = FakeSupervisor()
+
+    # Ran long enough, restarted right away
+    supervisor.children[1] = time.monotonic() - Supervisor.MIN_UPTIME - 1
+    supervisor.on_exit(1, 0)
+
+    assert supervisor.spawned == 1
+    assert supervisor.backoff.failures == 0
+    assert sleeps == []
+
+    # Crashed on startup, restarted with backoff
+    supervisor.children[2] = time.monotonic()
+    supervisor.on_exit(2, 1)
+
+    assert supervisor.spawned == 2
+    assert supervisor.backoff.failures == 1
+    assert sleeps == [supervisor.backoff.delay]
+    assert supervisor.children == {}
+
+
+def test_no_restart_when_stopping(monkeypatch):
+    monkeypatch.setattr('tg_pubsub.supervisor.time.sleep', lambda delay: None)
+
+    supervisor = FakeSupervisor()
+    supervisor.stopping = True
+    supervisor.children[1] = time.monotonic()
+    supervisor.on_exit(1, 0)
+
+    # Unknown pids are ignored
+    supervisor.stopping = False
+    supervisor.on_exit(2, 0)
+
+    assert supervisor.spawned == 0
+    assert supervisor.children == {}
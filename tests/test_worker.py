@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+import pytest
+
+
+class FakeSocket(object):
+    PERMISSION_DENIED_CLOSE_CODE = 1008
+
+    def __init__(self, allowed):
+        self.allowed = allowed
+        self.open = True
+
+        self.checked_in = None
+        self.closed = None
+
+    def has_permissions(self, request):
+        self.checked_in = threading.current_thread()
+
+        return self.allowed
+
+    async def close(self, code, reason):
+        self.open = False
+        self.closed = (code, reason)
+
+
+def test_check_permissions():
+    pytest.importorskip('websockets')
+
+    from tg_pubsub.worker import HandlerProtocol
+
+    assert HandlerProtocol(FakeSocket(True), None).check_permissions()
+    assert not HandlerProtocol(FakeSocket(False), None).check_permissions()
+
+
+def test_permission_denied():
+    pytest.importorskip('websockets')
+
+    from tg_pubsub.worker import WebSocketHandler
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    ws = FakeSocket(False)
+    loop.run_until_complete(WebSocketHandler(ws, None).run())
+
+    # Checked in the executor, not on the event loop
+    assert ws.checked_in is not None
+    assert ws.checked_in is not threading.current_thread()
+
+    assert ws.closed == (1008, 'Permission denied')
+
+    asyncio.set_event_loop(None)
+    loop.close()
@@ -3,3 +3,5 @@
 __author__ = 'Thorgate'
 __email__ = 'code@thorgate.eu'
 __version__ = '0.1.2'
+
+default_app_config = 'tg_pubsub.apps.TgPubsubConfig'
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class TgPubsubConfig(AppConfig):
+    name = 'tg_pubsub'
+    verbose_name = 'tg-pubsub'
+
+    def ready(self):
+        from .models import build_listenable_index, connect_signals, prepare_serializers
+        from .sessions import connect_signals as connect_session_signals
+
+        build_listenable_index()
+        connect_signals()
+        connect_session_signals()
+        prepare_serializers()
@@ -0,0 +1,98 @@
+import logging
+import threading
+
+from collections import OrderedDict
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .messages import ModelChanged, publish_many
+
+
+logger = logging.getLogger('tg_pubsub')
+
+_local = threading.local()
+
+
+class TransactionBuffer(object):
+    """ Model changes made inside a transaction. These are published in a single pipeline once the
+        transaction commits, and dropped if it is rolled back.
+
+        Repeated changes of the same instance are collapsed into the final action, a ``created`` followed by
+        ``saved`` stays ``created`` and a ``created`` followed by ``deleted`` is not published at all.
+
+        Note: Changes made inside a savepoint that is rolled back are still published if the outer
+        transaction commits.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.messages = OrderedDict()
+
+    def add(self, cls, action, instance, changed_fields=None):
+        key = (cls, instance.pk)
+        previous = self.messages.pop(key, None)
+
+        if previous is not None:
+            if previous.data['action'] == 'created':
+                if action == 'deleted':
+                    return
+
+                action = 'created'
+
+            elif previous.data['action'] == 'saved' and action == 'saved':
+                previous_changed = previous.changed_fields
+
+                if previous_changed is None or changed_fields is None:
+                    changed_fields = None
+
+                else:
+                    changed_fields = previous_changed | changed_fields
+
+        # The message is built right away since the instance loses its pk once deleted
+        self.messages[key] = ModelChanged(cls, action, instance, changed_fields)
+
+    def is_pending(self, connection):
+        """ Is the flush of this buffer still registered (i.e. the transaction has not been rolled back)
+        """
+        return any(hook[1] == self.flush for hook in connection.run_on_commit)
+
+    def flush(self):
+        buffers = getattr(_local, 'buffers', {})
+
+        if buffers.get(self.using) is self:
+            del buffers[self.using]
+
+        messages = list(self.messages.values())
+        self.messages.clear()
+
+        # Runs after the commit, an exception here would skip the remaining on_commit callbacks of the app
+        try:
+            publish_many(messages)
+
+        except Exception as e:
+            logger.warning("Failed to publish %d model changes: %s", len(messages), e)
+
+
+def get_transaction_buffer(using=None):
+    """ Get the buffer of the currently open transaction
+
+    :param using: Database alias
+    :return: TransactionBuffer or None if not inside a transaction
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+
+    # transaction.on_commit is only available since Django 1.9
+    if not connection.in_atomic_block or not hasattr(transaction, 'on_commit'):
+        return None
+
+    if not hasattr(_local, 'buffers'):
+        _local.buffers = {}
+
+    buffer = _local.buffers.get(using)
+
+    if buffer is None or not buffer.is_pending(connection):
+        buffer = _local.buffers[using] = TransactionBuffer(using)
+        transaction.on_commit(buffer.flush, using=using)
+
+    return buffer
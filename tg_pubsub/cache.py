@@ -0,0 +1,54 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """ Thread-safe LRU cache with a bounded size where entries also expire after `ttl` seconds
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        assert maxsize > 0
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+
+            except KeyError:
+                return default
+
+            if expires < self.timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.timer() + self.ttl, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
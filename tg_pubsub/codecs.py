@@ -0,0 +1,144 @@
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from rest_framework.utils import encoders
+
+
+# Used as the fallback of the faster encoders, so DRF types (Decimal, datetime, UUID, ...) are encoded the same way
+#  no matter which codec is used.
+drf_default = encoders.JSONEncoder().default
+
+
+class Codec(object):
+    """ Encodes message data for Redis and websocket frames.
+
+        Binary codecs produce bytes (sent as binary websocket frames), the others produce str.
+    """
+
+    name = None
+    binary = False
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    def decode(self, raw):
+        """ Decode raw data (str or bytes), must raise ValueError for invalid input
+        """
+        raise NotImplementedError
+
+    def encode_batch(self, frames):
+        """ Combine already encoded frames into a single frame containing an array of them
+        """
+        return '[%s]' % ','.join(frames)
+
+
+class JSONCodec(Codec):
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data, cls=encoders.JSONEncoder)
+
+    def decode(self, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+
+        return json.loads(raw)
+
+
+class OrjsonCodec(Codec):
+    """ JSON codec using orjson, produces the same output as JSONCodec
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        try:
+            import orjson
+
+        except ImportError:
+            raise ImproperlyConfigured('The orjson codec requires the orjson package')
+
+        self.orjson = orjson
+
+        # Let DRF encode datetimes, orjson uses a different format for them. Non-str keys are converted to
+        #  strings like the json module does.
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def encode(self, data):
+        return self.orjson.dumps(data, default=drf_default, option=self.options).decode('utf-8')
+
+    def decode(self, raw):
+        return self.orjson.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        try:
+            import msgpack
+
+        except ImportError:
+            raise ImproperlyConfigured('The msgpack codec requires the msgpack package')
+
+        self.msgpack = msgpack
+        self.unpack_options = {'raw': False}
+
+        # Since msgpack 1.0 only str and bytes keys are accepted by default, serializers can produce int keys
+        if msgpack.version >= (0, 6, 1):
+            self.unpack_options['strict_map_key'] = False
+
+    def encode(self, data):
+        return self.msgpack.packb(data, default=drf_default, use_bin_type=True)
+
+    def encode_batch(self, frames):
+        # A msgpack array is just the array header followed by the encoded items
+        count = len(frames)
+
+        if count < 16:
+            header = bytes([0x90 | count])
+
+        elif count < 2 ** 16:
+            header = b'\xdc' + count.to_bytes(2, 'big')
+
+        else:
+            header = b'\xdd' + count.to_bytes(4, 'big')
+
+        return header + b''.join(frames)
+
+    def decode(self, raw):
+        try:
+            return self.msgpack.unpackb(raw, **self.unpack_options)
+
+        except Exception as e:
+            raise ValueError(e)
+
+
+registry = {
+    JSONCodec.name: JSONCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+_codecs = {}
+
+
+def get_codec(name):
+    """ Get a codec instance by name (json, orjson, msgpack) or import path of a Codec subclass
+
+    :rtype: Codec
+    """
+    codec = _codecs.get(name)
+
+    if codec is None:
+        klass = registry[name] if name in registry else import_string(name)
+
+        if not issubclass(klass, Codec):
+            raise ImproperlyConfigured('Codec %s is not a Codec subclass' % name)
+
+        codec = _codecs[name] = klass()
+
+    return codec
@@ -29,6 +29,185 @@ def get_pubsub_server_ping_delta():
     return getattr(settings, 'TG_PUBSUB_PING_DELTA', 30)
 
 
+def get_heartbeat_slots():
+    return getattr(settings, 'TG_PUBSUB_HEARTBEAT_SLOTS', 64)
+
+
+def get_pubsub_server_workers():
+    return getattr(settings, 'TG_PUBSUB_WORKERS', 1)
+
+
+def get_pubsub_server_event_loop():
+    return getattr(settings, 'TG_PUBSUB_EVENT_LOOP', 'asyncio')
+
+
+def get_pubsub_server_shutdown_timeout():
+    return getattr(settings, 'TG_PUBSUB_SHUTDOWN_TIMEOUT', 10)
+
+
+def get_redis_max_connections():
+    return getattr(settings, 'TG_PUBSUB_REDIS_MAX_CONNECTIONS', None)
+
+
+def get_redis_socket_timeout():
+    return getattr(settings, 'TG_PUBSUB_REDIS_SOCKET_TIMEOUT', 5)
+
+
+def get_redis_connect_timeout():
+    return getattr(settings, 'TG_PUBSUB_REDIS_CONNECT_TIMEOUT', 5)
+
+
+def get_redis_health_check_interval():
+    return getattr(settings, 'TG_PUBSUB_REDIS_HEALTH_CHECK_INTERVAL', 30)
+
+
+def get_redis_retry_max():
+    return getattr(settings, 'TG_PUBSUB_REDIS_RETRY_MAX', 30)
+
+
+def get_batch_interval():
+    return getattr(settings, 'TG_PUBSUB_BATCH_INTERVAL', 0)
+
+
+def get_batch_size():
+    return getattr(settings, 'TG_PUBSUB_BATCH_SIZE', 100)
+
+
+def get_outbound_queue_size():
+    return getattr(settings, 'TG_PUBSUB_OUTBOUND_QUEUE_SIZE', 1000)
+
+
+def get_slow_consumer_policy():
+    from .outbound import OutboundQueue
+
+    policy = getattr(settings, 'TG_PUBSUB_SLOW_CONSUMER_POLICY', OutboundQueue.POLICY_DROP_OLDEST)
+
+    if policy not in OutboundQueue.POLICY_CHOICES:
+        raise ImproperlyConfigured(
+            'TG_PUBSUB_SLOW_CONSUMER_POLICY must be one of %s' % ', '.join(OutboundQueue.POLICY_CHOICES)
+        )
+
+    return policy
+
+
+def get_max_pending_messages():
+    return getattr(settings, 'TG_PUBSUB_MAX_PENDING_MESSAGES', 1000)
+
+
+def get_max_channels():
+    return getattr(settings, 'TG_PUBSUB_MAX_CHANNELS', 100)
+
+
+def get_slow_consumer_close_code():
+    return getattr(settings, 'TG_PUBSUB_SLOW_CONSUMER_CLOSE_CODE', 1008)
+
+
+def get_stats_interval():
+    return getattr(settings, 'TG_PUBSUB_STATS_INTERVAL', 0)
+
+
+def get_publish_on_commit():
+    return getattr(settings, 'TG_PUBSUB_PUBLISH_ON_COMMIT', False)
+
+
+def get_background_publish():
+    return getattr(settings, 'TG_PUBSUB_BACKGROUND_PUBLISH', False)
+
+
+def get_publish_queue_size():
+    return getattr(settings, 'TG_PUBSUB_PUBLISH_QUEUE_SIZE', 10000)
+
+
+def get_publish_batch_size():
+    return getattr(settings, 'TG_PUBSUB_PUBLISH_BATCH_SIZE', 100)
+
+
+def get_publish_overflow():
+    from .publisher import BackgroundPublisher
+
+    overflow = getattr(settings, 'TG_PUBSUB_PUBLISH_OVERFLOW', BackgroundPublisher.OVERFLOW_DROP)
+
+    if overflow not in BackgroundPublisher.OVERFLOW_CHOICES:
+        raise ImproperlyConfigured(
+            'TG_PUBSUB_PUBLISH_OVERFLOW must be one of %s' % ', '.join(BackgroundPublisher.OVERFLOW_CHOICES)
+        )
+
+    return overflow
+
+
+def get_embed_max_size():
+    return getattr(settings, 'TG_PUBSUB_EMBED_MAX_SIZE', 8192)
+
+
+def get_user_cache_size():
+    return getattr(settings, 'TG_PUBSUB_USER_CACHE_SIZE', 10000)
+
+
+def get_user_cache_ttl():
+    return getattr(settings, 'TG_PUBSUB_USER_CACHE_TTL', 0)
+
+
+def get_user_cache_negative_ttl():
+    return getattr(settings, 'TG_PUBSUB_USER_CACHE_NEGATIVE_TTL', get_user_cache_ttl())
+
+
+def get_db_executor_workers():
+    return getattr(settings, 'TG_PUBSUB_DB_WORKERS', 4)
+
+
+def get_db_max_in_flight():
+    return getattr(settings, 'TG_PUBSUB_DB_MAX_IN_FLIGHT', None) or get_db_executor_workers()
+
+
+def get_redis_codec():
+    return getattr(settings, 'TG_PUBSUB_CODEC', 'json')
+
+
+def get_websocket_codec():
+    return getattr(settings, 'TG_PUBSUB_WEBSOCKET_CODEC', 'json')
+
+
+def get_websocket_codecs():
+    return getattr(settings, 'TG_PUBSUB_WEBSOCKET_CODECS', ['msgpack'])
+
+
+def get_codec_param():
+    return getattr(settings, 'TG_PUBSUB_CODEC_PARAM', 'codec')
+
+
+def get_hello_packets_ttl():
+    return getattr(settings, 'TG_PUBSUB_HELLO_PACKETS_TTL', 0)
+
+
+_hello_packet_factories = None
+
+
+def get_hello_packet_factories():
+    """ Resolve the callables listed in TG_PUBSUB_HELLO_PACKETS, this is only done once per process
+
+    :rtype: list
+    """
+    global _hello_packet_factories
+
+    if _hello_packet_factories is None:
+        packets = getattr(settings, 'TG_PUBSUB_HELLO_PACKETS', [])
+
+        assert isinstance(packets, (list, tuple))
+
+        factories = []
+
+        for path in packets:
+            fn = import_string(path)
+
+            assert callable(fn)
+
+            factories.append(fn)
+
+        _hello_packet_factories = factories
+
+    return _hello_packet_factories
+
+
 def get_hello_packets():
     """ Get all packets to send right after doing websocket handshake
 
@@ -37,16 +216,9 @@ def get_hello_packets():
     """
     from .messages import BaseMessage
 
-    packets = getattr(settings, 'TG_PUBSUB_HELLO_PACKETS', [])
     res = []
 
-    assert isinstance(packets, (list, tuple))
-
-    for path in packets:
-        fn = import_string(path)
-
-        assert callable(fn)
-
+    for fn in get_hello_packet_factories():
         instance = fn()
         assert isinstance(instance, BaseMessage)
 
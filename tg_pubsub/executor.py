@@ -0,0 +1,59 @@
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .config import get_db_executor_workers, get_db_max_in_flight
+
+
+_executor = None
+_semaphore = None
+
+
+def get_executor():
+    """ Thread pool used by the pubsub server to run blocking database work off the event loop
+    """
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_db_executor_workers())
+
+    return _executor
+
+
+def get_semaphore():
+    global _semaphore
+
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(get_db_max_in_flight())
+
+    return _semaphore
+
+
+def _run_db_job(fn, *args, **kwargs):
+    # Worker threads keep their database connections between jobs, so apply the same connection
+    #  lifetime rules django uses around requests.
+    close_old_connections()
+
+    try:
+        return fn(*args, **kwargs)
+
+    finally:
+        close_old_connections()
+
+
+async def run_db_job(fn, *args, **kwargs):
+    """ Run blocking (database) work in the executor without stalling the event loop.
+
+        At most TG_PUBSUB_DB_MAX_IN_FLIGHT jobs are submitted at the same time, the rest wait here.
+        If TG_PUBSUB_DB_WORKERS is 0 the job is run inline.
+    """
+    if not get_db_executor_workers():
+        return fn(*args, **kwargs)
+
+    async with get_semaphore():
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(get_executor(), functools.partial(_run_db_job, fn, *args, **kwargs))
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+
+from .config import get_heartbeat_slots, get_pubsub_server_ping_delta
+
+
+logger = logging.getLogger('tg_pubsub.server')
+
+
+class Heartbeat(object):
+    """ Pings all the connections of a server process from a single hashed timer wheel.
+
+        The ping interval is split into `slots` buckets and every connection is put into one of them by its hash.
+        Every tick pings the connections of the next bucket, so each connection is pinged once per interval and
+        the pings are spread evenly over it instead of arriving in bursts.
+
+        A connection that has not answered its previous ping by the time its next ping is due is considered
+        dead and closed.
+
+        Ticks missed because the event loop was blocked are skipped rather than run back to back, and the timer
+        only runs while there are connections.
+    """
+
+    # Close code used for connections that stopped answering pings
+    DEAD_PEER_CLOSE_CODE = 1011
+
+    def __init__(self, interval, slots, loop=None):
+        self.interval = interval
+        self.slots = slots
+        self.tick = interval / slots if interval else None
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.wheel = [set() for i in range(slots)]
+        self.position = 0
+        self.count = 0
+
+        # HandlerProtocol -> task waiting for the pong of the last ping
+        self.pings = {}
+
+        self.handle = None
+        self.next_tick = None
+
+        # Metrics
+        self.dead = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, ws):
+        if not self.interval:
+            return
+
+        bucket = self.wheel[hash(ws) % self.slots]
+
+        if ws not in bucket:
+            bucket.add(ws)
+            self.count += 1
+
+        if self.handle is None:
+            self.next_tick = self.loop.time() + self.tick
+            self.handle = self.loop.call_at(self.next_tick, self.run_tick)
+
+    def remove(self, ws):
+        if not self.interval:
+            return
+
+        bucket = self.wheel[hash(ws) % self.slots]
+
+        if ws in bucket:
+            bucket.discard(ws)
+            self.count -= 1
+
+        task = self.pings.pop(ws, None)
+
+        if task is not None:
+            task.cancel()
+
+    def run_tick(self):
+        self.handle = None
+
+        bucket = self.wheel[self.position]
+        self.position = (self.position + 1) % self.slots
+
+        for ws in list(bucket):
+            task = self.pings.get(ws)
+
+            if task is not None and not task.done():
+                self.on_dead(ws)
+                continue
+
+            self.pings[ws] = self.loop.create_task(self.ping(ws))
+
+        if not self.count:
+            # Idle until the next connection is added
+            return
+
+        # Scheduled from the previous target time, so ticks do not drift
+        self.next_tick += self.tick
+        now = self.loop.time()
+
+        if self.next_tick < now:
+            # The loop was blocked, skip the missed ticks instead of pinging all their buckets at once
+            missed = int((now - self.next_tick) // self.tick) + 1
+
+            self.next_tick += missed * self.tick
+            self.position = (self.position + missed) % self.slots
+
+        self.handle = self.loop.call_at(self.next_tick, self.run_tick)
+
+    async def ping(self, ws):
+        """ Ping the connection and wait for the pong
+        """
+        try:
+            pong = await ws.ping()
+
+            if pong is not None:
+                await pong
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            # Connection is already closed, its handler removes it
+            pass
+
+    def on_dead(self, ws):
+        self.dead += 1
+        self.remove(ws)
+
+        logger.info("Closing connection %s, no pong received in %s seconds", ws.logging_key, self.interval)
+
+        self.loop.create_task(self.close(ws))
+
+    async def close(self, ws):
+        try:
+            await ws.close(self.DEAD_PEER_CLOSE_CODE, 'Ping timeout')
+
+        except Exception as e:
+            logger.debug("Failed to close connection %s: %s", ws.logging_key, e)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+_heartbeat = None
+_heartbeat_pid = None
+
+
+def get_heartbeat():
+    """ Get the heartbeat of the current process
+    """
+    global _heartbeat, _heartbeat_pid
+
+    if _heartbeat is None or _heartbeat_pid != os.getpid():
+        _heartbeat = Heartbeat(get_pubsub_server_ping_delta(), get_heartbeat_slots())
+        _heartbeat_pid = os.getpid()
+
+    return _heartbeat
@@ -1,13 +1,21 @@
 from django.core.management import BaseCommand
 
-from ...worker import run_pubsub_server
-from ...config import get_pubsub_server_host, get_pubsub_server_port
+from ...worker import EVENT_LOOP_CHOICES, run_pubsub_server
+from ...config import get_pubsub_server_host, get_pubsub_server_port, get_pubsub_server_workers
 
 
 class Command(BaseCommand):
     help = "Runs websocket-based pubsub server"
     args = '[optional port number]'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of worker processes sharing the port (default: TG_PUBSUB_WORKERS)")
+        parser.add_argument('--loop', choices=EVENT_LOOP_CHOICES, default=None,
+                            help="Event loop implementation (default: TG_PUBSUB_EVENT_LOOP)")
+
     def handle(self, port='', *args, **options):
         port = int(port) if port else get_pubsub_server_port()
-        run_pubsub_server(get_pubsub_server_host(), port)
+        workers = options.get('workers') or get_pubsub_server_workers()
+
+        run_pubsub_server(get_pubsub_server_host(), port, workers=workers, event_loop=options.get('loop'))
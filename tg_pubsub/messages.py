@@ -1,16 +1,30 @@
-import json
+import logging
 
-from rest_framework.utils import encoders
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
 
 from . import pubsub
 
-from .config import get_model, extra_models
-from .exceptions import IgnoreMessageException
+from .codecs import get_codec
+from .config import get_embed_max_size, get_model, get_redis_codec
+from .exceptions import IgnoreMessageException, InvalidMessageException
+
+
+logger = logging.getLogger('tg_pubsub.server')
 
 
 class BaseMessage(object):
     MESSAGE_IDENTIFIER = 'base'
 
+    # Set to True if prepare_for_send does blocking (e.g. database) work, the pubsub server will then run it
+    #  in the executor instead of the event loop.
+    prepare_in_executor = False
+
+    # Set to True for messages meant for the pubsub server itself, these are given to handle_on_server and
+    #  never sent to clients.
+    server_message = False
+
     def __init__(self, channels, data):
         assert ':' not in self.MESSAGE_IDENTIFIER
 
@@ -21,13 +35,18 @@ class BaseMessage(object):
         self.data = data
 
     def as_message(self):
+        codec = get_codec(get_redis_codec())
+
+        if codec.binary:
+            return b':'.join([self.MESSAGE_IDENTIFIER.encode('ascii'), codec.encode(self.data)])
+
         return ':'.join([
             self.MESSAGE_IDENTIFIER,
-            json.dumps(self.data, cls=encoders.JSONEncoder),
+            codec.encode(self.data),
         ])
 
-    def publish(self):
-        """ Publish message to redis queue
+    def get_publish_items(self):
+        """ Get the (channel, message) pairs to publish for this message
         """
         message = self.as_message()
 
@@ -35,62 +54,356 @@ class BaseMessage(object):
             if isinstance(channel, (list, tuple)):
                 channel = ':'.join(channel)
 
-            pubsub.publish(channel, message)
+            yield channel, message
+
+    def publish(self):
+        """ Publish message to all its channels in a single redis pipeline
+        """
+        pubsub.publish_many(self.get_publish_items())
+
+    @classmethod
+    def get_routing_keys(cls, data):
+        """ Get the channels clients can subscribe to for receiving this message
+
+        :param data: Message data
+        :return: List of channel names or None if the message should be sent to everyone
+        """
+        return None
+
+    @classmethod
+    def get_coalesce_key(cls, data):
+        """ Get the key used to collapse superseded messages that are still waiting to be sent to a client,
+            a message replaces the waiting message with the same key.
+
+        :param data: Message data
+        :return: Hashable key or None if the message should never be collapsed
+        """
+        return None
+
+    @classmethod
+    def handle_on_server(cls, data):
+        """ Handle a server message (see server_message), called once per pubsub server process
+
+            Does nothing by default, server messages override this to act on the message.
+        """
+        pass
 
     @classmethod
     def prepare_for_send(cls, ws, data):
         return data
 
+    @classmethod
+    def prepare_for_send_bulk(cls, recipients, data):
+        """ Prepare the message for all the recipients at once. The default implementation calls
+            prepare_for_send for every recipient.
+
+        :param recipients: List of HandlerProtocol instances
+        :param data: Message data
+        :return: List of (recipient, data) tuples for the recipients that should get the message
+        """
+        res = []
+
+        for ws in recipients:
+            try:
+                res.append((ws, cls.prepare_for_send(ws, data)))
+
+            except IgnoreMessageException:
+                pass
+
+        return res
+
 
 class ModelChanged(BaseMessage):
     MESSAGE_IDENTIFIER = 'model'
 
-    def __init__(self, klass, action, instance):
+    prepare_in_executor = True
+
+    def __init__(self, klass, action, instance, changed_fields=None):
         # We publish to `django`, `django:app_name-model_name`, `django:app_name-model_name:action`
         channels = ['django', '%s-%s' % (klass._meta.app_label, klass._meta.object_name), action]
 
-        super().__init__([channels[0:k] for k in range(1, len(channels) + 1)], {
+        self.changed_fields = changed_fields if action == 'saved' else None
+
+        data = {
             'app': klass._meta.app_label,
             'model': klass._meta.object_name,
             'action': action,
             'pk': instance.pk,
-        })
+        }
+
+        if self.changed_fields is not None:
+            data['changed'] = sorted(self.changed_fields)
+
+        embedded = self.get_embedded_data(klass, instance, self.changed_fields)
+
+        if embedded is not None:
+            data['data'] = embedded
+
+        super().__init__([channels[0:k] for k in range(1, len(channels) + 1)], data)
 
     @classmethod
-    def prepare_for_send(cls, ws, data):
-        from .models import ListenableModelMixin
+    def filter_changed(cls, serialized, changed_fields):
+        """ Reduce serialized data to the changed fields (and pk)
+        """
+        if not isinstance(serialized, dict):
+            return serialized
+
+        return {key: value for key, value in serialized.items() if key == 'pk' or key in changed_fields}
+
+    @classmethod
+    def get_embedded_data(cls, klass, instance, changed_fields=None):
+        """ Serialize the instance into the message if the listenable has pubsub_embed_data enabled, this
+            saves the pubsub server from fetching it from the database.
+
+        :return: Serialized instance or None if it should not (or is too large to) be embedded
+        """
+        from .models import get_listen_config
+
+        if get_listen_config(klass) is None:
+            return None
+
+        listener = cls.get_listener(klass, instance)
+
+        if not listener.pubsub_embed_data:
+            return None
+
+        serialized = listener.pubsub_serialize(instance, listener.get_serializer(instance))
+
+        if changed_fields is not None:
+            serialized = cls.filter_changed(serialized, changed_fields)
+
+        return serialized
+
+    def as_message(self):
+        message = super().as_message()
+
+        # The size limit is checked on the encoded message, so the data is only encoded again if it is too large
+        if 'data' in self.data and len(message) > get_embed_max_size():
+            del self.data['data']
+            message = super().as_message()
+
+        return message
+
+    @classmethod
+    def get_embedded_instance(cls, model, pk, serialized):
+        """ Build the instance given to the access checks from embedded data. This is only done for listenables with
+            pubsub_embed_access since fields that are not serialized keep their default values.
+
+        :return: Model instance or None if it should be fetched from the database instead
+        """
+        from .models import get_listen_config
+
+        config = get_listen_config(model)
+
+        if config is None or not config.pubsub_embed_access or not isinstance(serialized, dict):
+            return None
 
+        values = {}
+
+        try:
+            for field in model._meta.concrete_fields:
+                if field.name in serialized:
+                    values[field.attname] = field.to_python(serialized[field.name])
+
+        except ValidationError:
+            return None
+
+        inst = model(**values)
+        inst.pk = pk
+
+        return inst
+
+    @classmethod
+    def get_routing_keys(cls, data):
+        # Clients can subscribe to the whole model (app.Model) or a single instance (app.Model:pk)
         model_path = '%s.%s' % (data['app'], data['model'])
+
+        return [model_path, '%s:%s' % (model_path, data['pk'])]
+
+    @classmethod
+    def get_coalesce_key(cls, data):
+        # Only a full `saved` message supersedes a previous one, creates, deletes and partial updates are all sent
+        if data['action'] != 'saved' or 'changed' in data:
+            return None
+
+        return (cls.MESSAGE_IDENTIFIER, data['app'], data['model'], data['pk'])
+
+    @classmethod
+    def get_listener(cls, model, instance):
+        """ Get the object implementing the listenable api (has_access, pubsub_serialize, get_serializer) for model
+        """
+        from .models import get_listen_config
+
+        config = get_listen_config(model)
+
+        if config is None:
+            raise Exception('Model %s is not listenable' % model)
+
+        # Listenable models implement the api themselves
+        if config is model:
+            return instance
+
+        return config
+
+    @classmethod
+    def prepare_shared(cls, data):
+        """ Fetch and serialize the changed instance, prepare_for_send_bulk does this once for all recipients
+
+        :return: (listener, instance, payload)
+        """
         model = get_model(data['app'], data['model'])
-        inst = model.objects.get(pk=data['pk'])
 
-        if issubclass(model, ListenableModelMixin):
-            has_access = inst.has_access
-            pubsub_serialize = inst.pubsub_serialize
-            serializer = inst.get_serializer(inst)
+        if 'data' in data:
+            # Serialized by the publisher, the instance is still needed for the access checks
+            serialized = data['data']
+            inst = None
 
-        else:
-            if model_path in extra_models:
-                has_access = extra_models[model_path].has_access
-                pubsub_serialize = extra_models[model_path].pubsub_serialize
-                serializer = extra_models[model_path].get_serializer(inst)
+            if 'changed' not in data:
+                inst = cls.get_embedded_instance(model, data['pk'], serialized)
 
-            else:
-                raise Exception('Model %s is not listenable' % model)
+            if inst is None:
+                inst = cls.get_instance(model, data)
 
-        if not has_access(inst, ws.user):
-            raise IgnoreMessageException("Ignoring update on %s.%s:%s:%s, not authorized" % (data['app'], data['model'],
-                                                                                             data['action'],data['pk']))
+            listener = cls.get_listener(model, inst)
+
+        else:
+            inst = cls.get_instance(model, data)
+            listener = cls.get_listener(model, inst)
+            serialized = listener.pubsub_serialize(inst, listener.get_serializer(inst))
+
+            if 'changed' in data:
+                serialized = cls.filter_changed(serialized, set(data['changed']))
 
-        return {
+        payload = {
             'model': '%s.%s' % (data['app'], data['model']),
             'action': data['action'],
             'pk': data['pk'],
-            'data': pubsub_serialize(inst, serializer),
+            'data': serialized,
         }
 
+        if 'changed' in data:
+            payload['partial'] = True
+
+        return listener, inst, payload
+
+    @classmethod
+    def get_instance(cls, model, data):
+        """ Fetch the changed instance from the database
+
+        :raises IgnoreMessageException: If the instance of a `deleted` message is already gone
+        """
+        try:
+            return model.objects.get(pk=data['pk'])
+
+        except model.DoesNotExist:
+            if data['action'] != 'deleted':
+                raise
+
+            # Expected unless the data (and access checks) are embedded, see pubsub_embed_access
+            logger.debug("Not sending %s.%s:deleted:%s, the instance is already deleted", data['app'], data['model'],
+                         data['pk'])
+
+            raise IgnoreMessageException()
+
+    @classmethod
+    def prepare_for_send(cls, ws, data):
+        listener, inst, payload = cls.prepare_shared(data)
+
+        if not listener.has_access(inst, ws.user):
+            raise IgnoreMessageException("Ignoring update on %s.%s:%s:%s, not authorized" % (data['app'], data['model'],
+                                                                                             data['action'],data['pk']))
+
+        return payload
+
+    @classmethod
+    def prepare_for_send_bulk(cls, recipients, data):
+        try:
+            listener, inst, payload = cls.prepare_shared(data)
+
+        except IgnoreMessageException:
+            return []
+
+        # Every distinct user is checked only once, even if they have several connections
+        users = list(set(ws.user for ws in recipients))
+        allowed = set(listener.has_access_bulk(inst, users))
+
+        return [(ws, payload) for ws in recipients if ws.user in allowed]
+
+
+class SessionInvalidated(BaseMessage):
+    """ Tells the pubsub servers to forget the cached user of a session (see sessions.invalidate_session)
+    """
+
+    MESSAGE_IDENTIFIER = 'session'
+
+    server_message = True
+
+    def __init__(self, cache_key):
+        super().__init__('django', {'key': cache_key})
+
+    @classmethod
+    def handle_on_server(cls, data):
+        from .sessions import invalidate_cache_key
+
+        invalidate_cache_key(data['key'])
+
 
 registry = {
     BaseMessage.MESSAGE_IDENTIFIER: BaseMessage,
     ModelChanged.MESSAGE_IDENTIFIER: ModelChanged,
+    SessionInvalidated.MESSAGE_IDENTIFIER: SessionInvalidated,
 }
+
+
+def publish_many(messages):
+    """ Publish several messages in a single redis pipeline
+
+    :param messages: Iterable of BaseMessage instances
+    """
+    items = []
+
+    for message in messages:
+        items.extend(message.get_publish_items())
+
+    pubsub.publish_many(items)
+
+
+class DecodedMessage(namedtuple('DecodedMessage', ['message_class', 'data'])):
+    """ Message received from redis, decoded once and shared between all the handlers
+
+        Note: data must be treated as read-only since the same object is given to every handler.
+    """
+    __slots__ = ()
+
+
+def decode_message(message):
+    """ Decode a message received from redis
+
+    :param message: Message dict as returned by redis-py pubsub
+    :rtype: DecodedMessage
+    :raises InvalidMessageException: If the message is malformed or of an unknown type
+    """
+    msg_data = message['data']
+
+    if isinstance(msg_data, str):
+        msg_data = msg_data.encode('utf-8')
+
+    identifier, separator, data = msg_data.partition(b':')
+
+    if not (separator and identifier and data):
+        raise InvalidMessageException()
+
+    identifier = identifier.decode('ascii', 'replace')
+
+    # Only accept valid identifiers
+    if identifier not in registry:
+        raise InvalidMessageException()
+
+    # Parse the message body
+    try:
+        data = get_codec(get_redis_codec()).decode(data)
+
+    except ValueError:
+        raise InvalidMessageException()
+
+    return DecodedMessage(registry[identifier], data)
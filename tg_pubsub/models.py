@@ -1,24 +1,76 @@
+import copy
 import logging
 
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
-from django.db.models.signals import post_save, pre_delete
-from django.dispatch import receiver
+from django.db.models.signals import class_prepared, post_save, pre_delete
 
 from rest_framework.serializers import ModelSerializer
 
-from .config import extra_models, get_model
+from .buffer import get_transaction_buffer
+from .config import extra_models, get_model, get_publish_on_commit
 from .messages import ModelChanged
 
 logger = logging.getLogger('tg_pubsub')
 
 
+# (model, fields) -> serializer class generated for listenables without a serializer_class
+serializer_classes = {}
+
+
+class ListenableSerializer(ModelSerializer):
+    """ Base for the generated serializers. The fields of a model are introspected only once per serializer
+        class, each serializer instance gets a copy of them.
+    """
+
+    resolved_fields = None
+
+    def get_fields(self):
+        klass = self.__class__
+
+        if klass.resolved_fields is None:
+            klass.resolved_fields = super().get_fields()
+
+        return copy.deepcopy(klass.resolved_fields)
+
+
+def get_listenable_serializer_class(model_class, field_names):
+    """ Get (or build) the serializer class for model with the given fields
+    """
+    key = (model_class, tuple(field_names))
+
+    klass = serializer_classes.get(key)
+
+    if klass is None:
+        class Meta:
+            model = model_class
+            fields = key[1]
+
+        klass = type('%sListenableSerializer' % model_class.__name__, (ListenableSerializer, ), {
+            'Meta': Meta,
+            '__module__': __name__,
+        })
+
+        serializer_classes[key] = klass
+
+    return klass
+
+
 class ListenableBase(object):
     """ Base mixin that declares the api for listenables
     """
     serializer_class = None
     serializer_fields = ('pk', )
 
+    # Serialize the instance when publishing and send it along with the message (see TG_PUBSUB_EMBED_MAX_SIZE)
+    pubsub_embed_data = False
+
+    # has_access only uses serialized fields, so it can be given an instance built from the embedded data instead of
+    #  one fetched from the database
+    pubsub_embed_access = False
+
+    # Only send the changed fields for `saved` events
+    pubsub_send_diff = False
+
     def pubsub_get_model(self):
         return self.__class__
 
@@ -26,13 +78,7 @@ class ListenableBase(object):
         """ Return the class to use for the serializer.
         """
         if self.serializer_class is None:
-            class ListenableSerializer(ModelSerializer):
-                class Meta:
-                    model = self.pubsub_get_model()
-
-                    fields = self.serializer_fields
-
-            return ListenableSerializer
+            return get_listenable_serializer_class(self.pubsub_get_model(), self.serializer_fields)
 
         return self.serializer_class
 
@@ -51,6 +97,20 @@ class ListenableBase(object):
         """
         return True
 
+    @classmethod
+    def has_access_bulk(cls, instance, users):
+        """ Filter the given users down to the ones that have access to the model instance. The pubsub server calls
+            this once per change with all the connected users.
+
+            The default implementation calls has_access for every user, override it to do the check with a
+            single query (e.g. via ``pk__in``).
+
+        :param instance: Model instance
+        :param users:    List of users connected via pubsub
+        :return: The users (from the given list) that have access
+        """
+        return [user for user in users if cls.has_access(instance, user)]
+
     @classmethod
     def should_notify(cls, instance, action):
         """ Should the given instance send out a change notification. This can be used to limit publishes to only specific instances.
@@ -61,6 +121,45 @@ class ListenableBase(object):
         """
         return True
 
+    @classmethod
+    def pubsub_store_state(cls, instance):
+        """ Remember the current field values of instance, used for detecting changed fields (see pubsub_send_diff)
+        """
+        # Only look at loaded values, deferred fields would otherwise be fetched from the database
+        instance._pubsub_state = {
+            field.attname: instance.__dict__[field.attname]
+            for field in instance._meta.concrete_fields if field.attname in instance.__dict__
+        }
+
+    @classmethod
+    def get_changed_fields(cls, instance, update_fields=None):
+        """ Get the fields of instance that have changed since it was loaded (or last saved).
+
+        :param instance: Model instance
+        :param update_fields: update_fields given to save(), if any these are used as is
+        :return: Set of changed field names (both name and attname, e.g. owner and owner_id) including the primary key
+                 or None if unknown
+        """
+        if update_fields is not None:
+            names = set(update_fields)
+
+        else:
+            state = getattr(instance, '_pubsub_state', None)
+
+            if state is None:
+                return None
+
+            names = set(attname for attname, value in state.items() if instance.__dict__.get(attname, value) != value)
+
+        # The primary key is always sent
+        res = set(names) | {instance._meta.pk.name, instance._meta.pk.attname}
+
+        for field in instance._meta.concrete_fields:
+            if field.name in names or field.attname in names:
+                res.update((field.name, field.attname))
+
+        return res
+
     @classmethod
     def pubsub_serialize(cls, instance, serializer):
         """ Serialize the given model instance before sending it to the users.
@@ -75,7 +174,15 @@ class ListenableBase(object):
 class ListenableModelMixin(ListenableBase):
     """ Mixin that will mark model as 'listenable'. Such models will send messages to Redis queue whenever they're updated.
     """
-    pass
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        if cls.pubsub_send_diff:
+            cls.pubsub_store_state(instance)
+
+        return instance
 
 
 class ModelListenConfig(ListenableModelMixin):
@@ -98,50 +205,139 @@ class ModelListenConfig(ListenableModelMixin):
         return self.model
 
 
-def is_model_listenable(cls, action, instance):
-    if not issubclass(cls, models.Model):
-        return False
+# Model class -> listen config. This is the model itself for ListenableModelMixin subclasses and the
+#  ModelListenConfig instance for TG_PUBSUB_EXTRA_MODELS. Built when the app is ready.
+listenable_models = {}
 
-    if issubclass(cls, ListenableModelMixin):
-        should_notify = cls.should_notify
 
-    else:
-        model_path = '%s.%s' % (cls._meta.app_label, cls._meta.object_name)
+def build_listenable_index():
+    from django.apps import apps
 
-        if model_path in extra_models:
-            should_notify = extra_models[model_path].should_notify
+    index = {}
 
-        else:
-            return False
+    for model in apps.get_models():
+        if issubclass(model, ListenableModelMixin):
+            index[model] = model
+
+    for config in extra_models.values():
+        index[config.model] = config
+
+    listenable_models.clear()
+    listenable_models.update(index)
+
+    return listenable_models
+
+
+def get_listen_config(model):
+    """ Get the listen config of model
+
+    :return: The model class, ModelListenConfig instance or None if the model is not listenable
+    """
+    return listenable_models.get(model)
 
-    if not should_notify(instance, action):
+
+def get_sender_model(sender):
+    """ Django < 1.10 sends the signals of instances with deferred fields with a generated subclass of the model
+        as sender, get the actual model for those.
+    """
+    if getattr(sender, '_deferred', False):
+        return sender._meta.proxy_for_model
+
+    return sender
+
+
+def is_model_listenable(cls, action, instance):
+    config = listenable_models.get(cls)
+
+    if config is None:
+        return False
+
+    if not config.should_notify(instance, action):
         return False
 
     return True
 
 
-def model_changed(cls, action, instance):
+def model_changed(cls, action, instance, using=None, update_fields=None):
     # This should never cause problems for the outside code, so wrap it all in try: except:, just to be sure.
     try:
+        cls = get_sender_model(cls)
+
         if not is_model_listenable(cls, action, instance):
             return
 
         logging.info("model_changed(): %s-%s:%s:%s", cls._meta.app_label, cls._meta.object_name, action, str(instance.id))
 
-        ModelChanged(cls, action, instance).publish()
+        config = listenable_models[cls]
+        changed_fields = None
+
+        if config.pubsub_send_diff and action != 'deleted':
+            if action == 'saved':
+                changed_fields = config.get_changed_fields(instance, update_fields)
+
+            config.pubsub_store_state(instance)
+
+        buffer = get_transaction_buffer(using) if get_publish_on_commit() else None
+
+        if buffer is not None:
+            buffer.add(cls, action, instance, changed_fields)
+
+        else:
+            ModelChanged(cls, action, instance, changed_fields).publish()
 
     except Exception as e:
         logging.warning("Exception in model_changed(%s, %s, %s: %s): %s", cls, action, type(instance), getattr(instance, 'id', '-'), e)
 
 
-@receiver(post_save)
-def model_post_save_handler(sender, instance, created, **kwargs):
+def model_post_save_handler(sender, instance, created, using=None, update_fields=None, **kwargs):
     if created:
-        model_changed(sender, 'created', instance)
+        model_changed(sender, 'created', instance, using=using)
     else:
-        model_changed(sender, 'saved', instance)
+        model_changed(sender, 'saved', instance, using=using, update_fields=update_fields)
+
+
+def model_pre_delete_handler(sender, instance, using=None, **kwargs):
+    model_changed(sender, 'deleted', instance, using=using)
+
+
+def connect_model_signals(model):
+    post_save.connect(model_post_save_handler, sender=model, dispatch_uid='tg_pubsub.model_post_save_handler')
+    pre_delete.connect(model_pre_delete_handler, sender=model, dispatch_uid='tg_pubsub.model_pre_delete_handler')
+
+
+def model_class_prepared_handler(sender, **kwargs):
+    # Deferred field subclasses (Django < 1.10) are created on demand, so their signals are connected as they appear
+    model = get_sender_model(sender)
 
+    if model is not sender and model in listenable_models:
+        connect_model_signals(sender)
+
+
+def connect_signals():
+    """ Connect the signal handlers for listenable models only, so saving other models costs nothing
+    """
+    for model in listenable_models:
+        connect_model_signals(model)
+
+    class_prepared.connect(model_class_prepared_handler, dispatch_uid='tg_pubsub.model_class_prepared_handler')
+
+
+def prepare_serializers():
+    """ Build the generated serializer classes of all listenables and resolve their fields, so it does not happen
+        while sending the first messages.
+    """
+    serializers = []
+
+    for model, config in listenable_models.items():
+        if config.serializer_class is not None:
+            continue
+
+        if config is model:
+            serializers.append(get_listenable_serializer_class(model, model.serializer_fields))
+
+        else:
+            serializers.append(config.get_serializer_class())
 
-@receiver(pre_delete)
-def model_pre_delete_handler(sender, instance, **kwargs):
-    model_changed(sender, 'deleted', instance)
+    for serializer_class in serializers:
+        # Accessing fields triggers get_fields
+        serializer_class().fields
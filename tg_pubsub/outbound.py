@@ -0,0 +1,153 @@
+import asyncio
+
+from collections import deque
+
+
+class OutboundQueue(object):
+    """ Encoded frames waiting to be sent to a single connection.
+
+        Frames can be put with a coalesce key (see BaseMessage.get_coalesce_key), a frame with the same key
+        as a frame that is still waiting replaces it instead of being queued separately. The new frame is
+        queued at the end, so it is never sent before frames that were queued after the replaced one.
+
+        The queue holds at most `maxsize` frames, what happens when a slow client lets it fill up is
+        controlled by `policy`:
+
+         - POLICY_DROP_OLDEST: Drop the oldest waiting frame
+         - POLICY_COALESCE: Frames that replace a waiting frame are still accepted, other new frames are dropped
+         - POLICY_DISCONNECT: Close the queue and mark it as overflowed, the handler then closes the connection
+    """
+
+    POLICY_DROP_OLDEST = 'drop_oldest'
+    POLICY_COALESCE = 'coalesce'
+    POLICY_DISCONNECT = 'disconnect'
+
+    POLICY_CHOICES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+    def __init__(self, maxsize=0, policy=POLICY_DROP_OLDEST):
+        assert policy in self.POLICY_CHOICES
+
+        self.maxsize = maxsize
+        self.policy = policy
+
+        # [key, frame] lists, key -> entry of the frames still waiting. Replaced entries stay in the deque with
+        #  their frame set to None until they are popped (or compacted away).
+        self.entries = deque()
+        self.keys = {}
+        self.replaced = 0
+
+        self.closed = False
+        self.overflowed = False
+        self.waiter = None
+
+        # Metrics
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.entries) - self.replaced
+
+    def put(self, frame, key=None):
+        if self.closed:
+            return
+
+        if key is not None:
+            entry = self.keys.pop(key, None)
+
+            if entry is not None:
+                entry[1] = None
+                self.replaced += 1
+                self.coalesced += 1
+
+                self.append(key, frame)
+                self.compact()
+                return
+
+        if self.maxsize and len(self) >= self.maxsize:
+            if self.policy == self.POLICY_DISCONNECT:
+                self.dropped += len(self) + 1
+                self.overflowed = True
+                self.close()
+                return
+
+            if self.policy == self.POLICY_COALESCE:
+                self.dropped += 1
+                return
+
+            self.pop()
+            self.dropped += 1
+
+        self.append(key, frame)
+
+    def append(self, key, frame):
+        entry = [key, frame]
+        self.entries.append(entry)
+
+        if key is not None:
+            self.keys[key] = entry
+
+        self.max_depth = max(self.max_depth, len(self))
+
+        self.wakeup()
+
+    def compact(self):
+        # Keep a client that is not reading from piling up replaced entries
+        if self.replaced > len(self):
+            self.entries = deque(entry for entry in self.entries if entry[1] is not None)
+            self.replaced = 0
+
+    def pop(self):
+        while True:
+            key, frame = self.entries.popleft()
+
+            if frame is not None:
+                break
+
+            self.replaced -= 1
+
+        if key is not None:
+            del self.keys[key]
+
+        return frame
+
+    async def get(self):
+        """ Wait for the next frame
+
+        :return: The frame or None if the queue has been closed
+        """
+        while not len(self) and not self.closed:
+            self.waiter = asyncio.Future()
+
+            try:
+                await self.waiter
+
+            finally:
+                self.waiter = None
+
+        if self.closed:
+            return None
+
+        return self.pop()
+
+    def get_many(self, max_size):
+        """ Take up to max_size frames without waiting
+        """
+        frames = []
+
+        while len(self) and len(frames) < max_size:
+            frames.append(self.pop())
+
+        return frames
+
+    def close(self):
+        self.closed = True
+        self.entries.clear()
+        self.keys.clear()
+        self.replaced = 0
+
+        self.wakeup()
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
@@ -1,27 +1,24 @@
 import websockets
 
-from importlib import import_module
 from urllib.parse import parse_qs, urlparse
 
 from django.conf import settings
 from django.utils.functional import SimpleLazyObject
 
+from .sessions import get_cached_user, session_engine
+
 
 class FakeRequest(object):
     def __init__(self, path, session_key):
-        from django.contrib.auth.middleware import get_user
-
         self.session_key = session_key
 
         self.path = path
-        self.user = SimpleLazyObject(lambda: get_user(self))
+        self.user = SimpleLazyObject(lambda: get_cached_user(self))
 
     @property
     def session(self):
         if not hasattr(self, '_session'):
-            engine = import_module(settings.SESSION_ENGINE)
-
-            setattr(self, '_session', engine.SessionStore(self.session_key))
+            setattr(self, '_session', session_engine.SessionStore(self.session_key))
 
         return getattr(self, '_session')
 
@@ -29,10 +26,17 @@ class FakeRequest(object):
 class RequestServerProtocol(websockets.server.WebSocketServerProtocol):
     """ WebSocketServerProtocol that gives handler a request-like
         object which might contain the session/user if token was provided.
+
+        Since resolving the user hits the session store and the database, `has_permissions` is not checked
+        during the handshake but by the handler once the user has been loaded in the executor. Connections
+        without permissions are closed with `PERMISSION_DENIED_CLOSE_CODE`.
     """
 
     TOKEN_PARAM = 'token'
 
+    # Policy violation
+    PERMISSION_DENIED_CLOSE_CODE = 1008
+
     def get_handler_kwargs(self, path, get_header):
         query_dict = parse_qs(urlparse(path).query)
 
@@ -45,6 +49,11 @@ class RequestServerProtocol(websockets.server.WebSocketServerProtocol):
             'request': request,
         }
 
+    def has_permissions(self, request):
+        """ Check if the client may connect, called in the executor
+        """
+        return True
+
 
 class SessionRequiredServerProtocol(RequestServerProtocol):
     """ WebSocketServerProtocol which only allows handshakes with a valid token
@@ -67,14 +76,6 @@ class AnyUserServerProtocol(SessionRequiredServerProtocol):
     def has_permissions(self, request):
         return request is not None
 
-    def get_handler_kwargs(self, path, get_header):
-        handler_kwargs = super().get_handler_kwargs(path, get_header)
-
-        if not self.has_permissions(handler_kwargs['request']):
-            raise websockets.InvalidOrigin('Permission denied')
-
-        return handler_kwargs
-
 
 class AnonymousUserServerProtocol(AnyUserServerProtocol):
     """ WebSocketServerProtocol implementation that only allows anonymous users
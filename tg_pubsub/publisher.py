@@ -0,0 +1,144 @@
+import atexit
+import logging
+import os
+import threading
+
+from collections import deque
+
+
+logger = logging.getLogger('tg_pubsub')
+
+
+class BackgroundPublisher(object):
+    """ Publishes messages from a bounded in-memory queue in a background thread, so that publishing never
+        blocks the thread that saved the model.
+
+        The queue is drained in batches of up to `batch_size` publishes, every batch is sent via `send`
+        (a single redis pipeline). What happens when the queue is full is controlled by `overflow`:
+
+         - OVERFLOW_DROP_OLDEST: Drop the oldest queued message to make room for the new one
+         - OVERFLOW_BLOCK: Block the caller until there is room
+         - OVERFLOW_DROP: Drop the new message
+
+        Dropped messages are counted in `dropped`. Queued messages are flushed on interpreter shutdown, messages
+        put after that (e.g. by other atexit handlers) are sent synchronously.
+    """
+
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP = 'drop'
+
+    OVERFLOW_CHOICES = (OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK, OVERFLOW_DROP)
+
+    SHUTDOWN_TIMEOUT = 5.0
+
+    def __init__(self, send, maxsize, batch_size, overflow):
+        assert overflow in self.OVERFLOW_CHOICES
+
+        self.send = send
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.overflow = overflow
+
+        self.dropped = 0
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.run, name='tg_pubsub.publisher')
+        self.thread.daemon = True
+        self.thread.start()
+
+        atexit.register(self.stop)
+
+    def put(self, items):
+        """ Queue a message for publishing
+
+        :param items: List of (channel, message) tuples of a single message
+        """
+        with self.condition:
+            if len(self.queue) >= self.maxsize and not self.stopping:
+                if self.overflow == self.OVERFLOW_BLOCK:
+                    while len(self.queue) >= self.maxsize and not self.stopping:
+                        self.condition.wait()
+
+                elif self.overflow == self.OVERFLOW_DROP_OLDEST:
+                    self.queue.popleft()
+                    self.on_dropped()
+
+                else:
+                    self.on_dropped()
+                    return
+
+            if not self.stopping:
+                self.queue.append(items)
+                self.condition.notify_all()
+                return
+
+        # The thread is flushing or already gone and would never see the message
+        self.publish(items)
+
+    def on_dropped(self):
+        self.dropped += 1
+
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning("Publish queue is full, %d messages dropped so far", self.dropped)
+
+    def take_batch(self):
+        with self.condition:
+            while not self.queue and not self.stopping:
+                self.condition.wait()
+
+            batch = []
+
+            while self.queue and len(batch) < self.batch_size:
+                batch.extend(self.queue.popleft())
+
+            self.condition.notify_all()
+
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+
+            if not batch:
+                # Only happens when stopping and the queue is empty
+                return
+
+            self.publish(batch)
+
+    def publish(self, items):
+        try:
+            self.send(items)
+
+        except Exception as e:
+            logger.warning("Failed to publish %d messages: %s", len(items), e)
+
+    def stop(self, timeout=None):
+        """ Stop the publisher thread, after flushing what is still queued
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+        self.thread.join(self.SHUTDOWN_TIMEOUT if timeout is None else timeout)
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher(send, maxsize, batch_size, overflow):
+    """ Get the background publisher of the current process (a new one is started after fork)
+    """
+    global _publisher, _publisher_pid
+
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = BackgroundPublisher(send, maxsize, batch_size, overflow)
+            _publisher_pid = os.getpid()
+
+        return _publisher
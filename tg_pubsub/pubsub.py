@@ -1,38 +1,188 @@
 import logging
+import threading
+import time
 
 from django.conf import settings
 
 import redis
 
+from .config import (
+    get_background_publish, get_publish_batch_size, get_publish_overflow, get_publish_queue_size,
+    get_redis_connect_timeout, get_redis_health_check_interval, get_redis_max_connections, get_redis_retry_max,
+    get_redis_socket_timeout,
+)
+from .publisher import get_publisher
 
 logger = logging.getLogger('tg_pubsub')
 
 
+class Backoff(object):
+    """ Exponential backoff used to not hammer Redis (or block the callers on connect timeouts) while it is down
+    """
+
+    def __init__(self, base=0.5, maximum=None):
+        self.base = base
+        self.maximum = get_redis_retry_max() if maximum is None else maximum
+
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.retry_at
+
+    @property
+    def delay(self):
+        return min(self.maximum, self.base * 2 ** max(self.failures - 1, 0))
+
+    def failed(self):
+        self.failures += 1
+        self.retry_at = time.monotonic() + self.delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0
+
+
+_connection_pool = None
+
+
+def get_connection_pool():
+    """ Connection pool shared by the publishing client and the pubsub server subscriptions
+    """
+    global _connection_pool
+
+    if _connection_pool is None:
+        _connection_pool = redis.ConnectionPool(
+            host=getattr(settings, 'REDIS_HOST', 'localhost'),
+            port=getattr(settings, 'REDIS_PORT', 6379),
+            # NB: for pubsub, the database number doesn't matter. At all.
+            db=getattr(settings, 'REDIS_DB', 0),
+            max_connections=get_redis_max_connections(),
+            socket_timeout=get_redis_socket_timeout(),
+            socket_connect_timeout=get_redis_connect_timeout(),
+            # Lets the OS detect dead peers on otherwise idle (subscription) connections
+            socket_keepalive=True,
+        )
+
+    return _connection_pool
+
+
 def create_redis_connection():
-    redis_host = getattr(settings, 'REDIS_HOST', 'localhost')
-    redis_port = getattr(settings, 'REDIS_PORT', 6379)
-    redis_db = getattr(settings, 'REDIS_DB', 0)
+    """ Create a client using the shared connection pool and check that Redis is reachable
+
+    :return: StrictRedis or None if Redis isn't available
+    """
+    r = redis.StrictRedis(connection_pool=get_connection_pool())
 
-    # NB: for pubsub, the database number doesn't matter. At all.
-    r = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
     try:
         r.ping()
-    except redis.exceptions.ConnectionError as e:
-        logger.warning("Redis isn't available, pubsub will be disabled: %s", e)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning("Redis isn't available: %s", e)
         return None
 
     logger.info("Connected to Redis")
     return r
 
 
-redis_connection = create_redis_connection()
+class RedisConnection(object):
+    """ Lazily connected client used for publishing.
+
+        After a connection error publishes are dropped until the backoff delay has passed, after which the
+        connection is health checked and used again. Connections idle for longer than
+        TG_PUBSUB_REDIS_HEALTH_CHECK_INTERVAL are also checked before use.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.backoff = Backoff()
+        self.last_used = None
+
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        """ Get a client that is (as far as we know) connected
+
+        :return: StrictRedis or None if Redis is unavailable
+        """
+        with self.lock:
+            if not self.backoff.available:
+                return None
+
+            now = time.monotonic()
+            interval = get_redis_health_check_interval()
+
+            needs_check = self.client is None or self.backoff.failures or (
+                interval and self.last_used is not None and now - self.last_used > interval
+            )
+
+            if self.client is None:
+                self.client = redis.StrictRedis(connection_pool=get_connection_pool())
+
+            if needs_check:
+                try:
+                    self.client.ping()
+
+                except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                    self.failed(e)
+                    return None
+
+                if self.backoff.failures:
+                    logger.info("Reconnected to Redis")
+
+                self.backoff.succeeded()
+
+            self.last_used = now
+
+            return self.client
+
+    def failed(self, e):
+        self.backoff.failed()
+
+        logger.warning("Redis isn't available, retrying in %.1f seconds: %s", self.backoff.delay, e)
+
+
+redis_connection = RedisConnection()
 
 
 def publish(channel, message):
-    if redis_connection is None:
+    publish_many([(channel, message)])
+
+
+def publish_many(items):
+    """ Publish several messages with a single round trip
+
+        If TG_PUBSUB_BACKGROUND_PUBLISH is enabled the messages are queued and published by a background thread.
+
+    :param items: Iterable of (channel, message) tuples
+    """
+    items = list(items)
+
+    if not items:
         return
 
+    if get_background_publish():
+        publisher = get_publisher(send_many, get_publish_queue_size(), get_publish_batch_size(), get_publish_overflow())
+        publisher.put(items)
+
+    else:
+        send_many(items)
+
+
+def send_many(items):
+    """ Send the given (channel, message) tuples to redis in a single pipeline
+    """
+    client = redis_connection.get_client()
+
+    if client is None:
+        return
+
+    pipe = client.pipeline(transaction=False)
+
+    for channel, message in items:
+        pipe.publish(channel, message)
+
     try:
-        redis_connection.publish(channel, message)
-    except redis.exceptions.ConnectionError as e:
-        logger.warning("Redis seems to have died: %s", e)
+        pipe.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        redis_connection.failed(e)
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete
+from django.utils.functional import SimpleLazyObject
+
+from .cache import TTLCache
+from .config import get_user_cache_negative_ttl, get_user_cache_size, get_user_cache_ttl
+
+
+logger = logging.getLogger('tg_pubsub')
+
+
+session_engine = SimpleLazyObject(lambda: import_module(settings.SESSION_ENGINE))
+
+# Hashed session key -> user, and hashed session keys that did not resolve to a user
+user_cache = SimpleLazyObject(lambda: TTLCache(get_user_cache_size(), get_user_cache_ttl()))
+invalid_session_cache = SimpleLazyObject(lambda: TTLCache(get_user_cache_size(), get_user_cache_negative_ttl()))
+
+
+def get_cache_key(session_key):
+    # Session keys are secrets, so they are neither kept in memory nor sent via redis as is
+    return hashlib.sha256(session_key.encode('utf-8')).hexdigest()
+
+
+def get_cached_user(request):
+    """ Get the user of a request, the result is cached by session key for TG_PUBSUB_USER_CACHE_TTL seconds so
+        clients reconnecting do not hit the session store and the database every time.
+
+        Note: Cached users are shared between connections and changes to them are only seen after the ttl.
+
+    :param request: Request-like object with session_key and session attributes
+    """
+    from django.contrib.auth.middleware import get_user
+    from django.contrib.auth.models import AnonymousUser
+
+    if not request.session_key:
+        return AnonymousUser()
+
+    if not get_user_cache_ttl():
+        return get_user(request)
+
+    key = get_cache_key(request.session_key)
+
+    user = user_cache.get(key)
+
+    if user is not None:
+        return user
+
+    if invalid_session_cache.get(key):
+        return AnonymousUser()
+
+    user = get_user(request)
+
+    if user.is_authenticated():
+        user_cache.set(key, user)
+
+    else:
+        invalid_session_cache.set(key, True)
+
+    return user
+
+
+def invalidate_cache_key(key):
+    user_cache.delete(key)
+    invalid_session_cache.delete(key)
+
+
+def invalidate_session(session_key):
+    """ Drop the cached user of a session in all pubsub server processes. Logouts and deleting sessions of
+        database backed session engines are handled automatically, call this when deleting sessions of other
+        engines.
+
+        Note: This is done even if TG_PUBSUB_USER_CACHE_TTL is not set, since only the pubsub server might have it.
+    """
+    from .messages import SessionInvalidated
+
+    if not session_key:
+        return
+
+    key = get_cache_key(session_key)
+
+    invalidate_cache_key(key)
+
+    # Logging out should never fail because of the pubsub server, so just log errors
+    try:
+        SessionInvalidated(key).publish()
+
+    except Exception as e:
+        logger.warning("Failed to publish session invalidation: %s", e)
+
+
+def user_logged_out_handler(sender, request, user, **kwargs):
+    session = getattr(request, 'session', None)
+
+    if session is not None:
+        invalidate_session(session.session_key)
+
+
+def session_post_delete_handler(sender, instance, **kwargs):
+    invalidate_session(instance.session_key)
+
+
+def get_session_model():
+    """ Get the session model of the session engine
+
+    :return: Model class or None if the engine does not store sessions in the database
+    """
+    from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
+
+    store_class = session_engine.SessionStore
+
+    if not issubclass(store_class, DatabaseSessionStore):
+        return None
+
+    try:
+        if hasattr(store_class, 'get_model_class'):
+            return store_class.get_model_class()
+
+        from django.contrib.sessions.models import Session
+
+        return Session
+
+    except RuntimeError:
+        # The sessions app is not installed
+        return None
+
+
+def connect_signals():
+    user_logged_out.connect(user_logged_out_handler, dispatch_uid='tg_pubsub.user_logged_out_handler')
+
+    session_model = get_session_model()
+
+    if session_model is not None:
+        post_delete.connect(session_post_delete_handler, sender=session_model,
+                            dispatch_uid='tg_pubsub.session_post_delete_handler')
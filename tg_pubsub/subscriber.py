@@ -0,0 +1,437 @@
+import asyncio
+import logging
+import os
+import re
+
+import redis
+
+from . import pubsub
+
+from .config import (
+    get_max_channels, get_max_pending_messages, get_outbound_queue_size, get_slow_consumer_policy, get_stats_interval,
+)
+from .exceptions import InvalidMessageException
+from .executor import run_db_job
+from .heartbeat import get_heartbeat
+from .messages import decode_message
+from .outbound import OutboundQueue
+
+
+logger = logging.getLogger('tg_pubsub.server')
+
+
+class SubscriberPubSub(redis.client.PubSub):
+    """ PubSub that lets connection errors through instead of reconnecting (and blocking) inside get_message,
+        the Subscriber reconnects by itself so the event loop always watches the current socket.
+    """
+
+    def _execute(self, connection, command, *args):
+        return command(*args)
+
+
+class Subscriber(object):
+    """ Single Redis subscription shared by all websocket handlers of a server process.
+
+        Every message is read from Redis once, prepared once for all the registered handlers (see
+        BaseMessage.prepare_for_send_bulk) and the results are put to the queues of the handlers
+        that should receive it. The Redis socket is registered with the event loop, so messages
+        are pushed to the handlers as soon as they arrive and an idle server does no work.
+    """
+
+    # Channels clients can subscribe to: app_label.ModelName or app_label.ModelName:pk
+    CHANNEL_RE = re.compile(r'\w+\.\w+(:[\w-]+)?')
+    MAX_CHANNEL_LENGTH = 200
+
+    def __init__(self, channels=('django', ), loop=None):
+        self.channels = channels
+        self.loop = loop or asyncio.get_event_loop()
+
+        # HandlerProtocol -> OutboundQueue
+        self.handlers = {}
+
+        # Connections that have not subscribed to any channels yet, these get every message
+        self.firehose = set()
+
+        # Channel -> set of HandlerProtocol and HandlerProtocol -> set of channels
+        self.channel_index = {}
+        self.subscriptions = {}
+
+        # Messages being prepared, in the order they were received. Reading from Redis is paused while this is
+        #  full, so a slow executor can not make it grow without limit.
+        self.pending = asyncio.Queue(get_max_pending_messages())
+        self.paused = False
+
+        self.started = False
+        self.pubsub = None
+
+        # Socket (and its fd) the event loop is watching
+        self.sock = None
+        self.fileno = None
+        self.backoff = pubsub.Backoff()
+
+        # Metrics of connections that have already been closed
+        self.dropped = 0
+        self.disconnected = 0
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.loop.create_task(self.deliver())
+
+            if get_stats_interval():
+                self.loop.create_task(self.log_stats(get_stats_interval()))
+
+            self.connect()
+
+    def register(self, ws):
+        """ Register a new listener
+
+        :param ws: HandlerProtocol of the connection
+        :return: Queue which will receive encoded frames of all messages the connection should get
+        :rtype: OutboundQueue
+        """
+        self.start()
+
+        queue = OutboundQueue(get_outbound_queue_size(), get_slow_consumer_policy())
+        self.handlers[ws] = queue
+        self.firehose.add(ws)
+
+        return queue
+
+    def unregister(self, ws):
+        self.unsubscribe(ws, list(self.subscriptions.get(ws, ())))
+
+        queue = self.handlers.pop(ws, None)
+
+        if queue is not None:
+            self.dropped += queue.dropped
+            self.disconnected += int(queue.overflowed)
+        self.firehose.discard(ws)
+        self.subscriptions.pop(ws, None)
+
+    @classmethod
+    def is_valid_channel(cls, channel):
+        return len(channel) <= cls.MAX_CHANNEL_LENGTH and cls.CHANNEL_RE.fullmatch(channel) is not None
+
+    def subscribe(self, ws, channels):
+        """ Subscribe the connection to the given channels (see BaseMessage.get_routing_keys). After the first
+            subscribe the connection only receives messages of the channels it is subscribed to.
+
+            Invalid channels and channels over the TG_PUBSUB_MAX_CHANNELS limit of the connection are ignored.
+        """
+        if ws not in self.handlers:
+            return
+
+        subscribed = self.subscriptions.setdefault(ws, set())
+        max_channels = get_max_channels()
+
+        for channel in channels:
+            if not self.is_valid_channel(channel):
+                logger.debug("Ignoring invalid channel %.100r", channel)
+                continue
+
+            if channel not in subscribed and len(subscribed) >= max_channels:
+                logger.debug("Ignoring channels over the limit of %d channels", max_channels)
+                break
+
+            subscribed.add(channel)
+            self.channel_index.setdefault(channel, set()).add(ws)
+
+        if subscribed:
+            self.firehose.discard(ws)
+
+    def unsubscribe(self, ws, channels):
+        subscribed = self.subscriptions.get(ws)
+
+        if not subscribed:
+            return
+
+        for channel in channels:
+            subscribed.discard(channel)
+
+            connections = self.channel_index.get(channel)
+
+            if connections is not None:
+                connections.discard(ws)
+
+                if not connections:
+                    del self.channel_index[channel]
+
+    def get_recipients(self, message):
+        """ Get the connections that should receive the message. Apart from the connections without
+            subscriptions this only touches the connections subscribed to the routing keys of the message.
+        """
+        keys = message.message_class.get_routing_keys(message.data)
+
+        if keys is None:
+            return list(self.handlers.keys())
+
+        recipients = set(self.firehose)
+
+        for key in keys:
+            recipients.update(self.channel_index.get(key, ()))
+
+        return list(recipients)
+
+    def dispatch(self, msg):
+        try:
+            message = decode_message(msg)
+
+        except InvalidMessageException:
+            logger.debug("Ignoring invalid message from Redis: %s", msg)
+            return
+
+        if message.message_class.server_message:
+            try:
+                message.message_class.handle_on_server(message.data)
+
+            except Exception as e:
+                logger.warning("Failed to handle %s: %s", message, e)
+
+            return
+
+        # Messages are prepared concurrently but delivered in order
+        self.pending.put_nowait((message, self.loop.create_task(self.prepare(message))))
+
+    async def prepare(self, message):
+        recipients = self.get_recipients(message)
+
+        if not recipients:
+            return []
+
+        if message.message_class.prepare_in_executor:
+            return await run_db_job(message.message_class.prepare_for_send_bulk, recipients, message.data)
+
+        return message.message_class.prepare_for_send_bulk(recipients, message.data)
+
+    async def deliver(self):
+        while True:
+            message, task = await self.pending.get()
+
+            if self.paused and self.pending.qsize() <= self.pending.maxsize // 2:
+                self.resume()
+
+            try:
+                prepared = await task
+
+            except Exception as e:
+                logger.warning("Failed to prepare %s: %s", message, e)
+                continue
+
+            self.broadcast(message, prepared)
+
+    def broadcast(self, message, prepared):
+        """ Put prepared data to the queues of the recipients.
+
+            Recipients usually share the same prepared data, so each distinct payload is encoded only
+            once per codec and the resulting frame is given to all of them. Only payloads customized
+            per recipient (see BaseMessage.prepare_for_send) end up being encoded separately.
+
+        :param message: DecodedMessage
+        :param prepared: List of (HandlerProtocol, data) tuples
+        """
+        key = message.message_class.get_coalesce_key(message.data)
+
+        # (id(data), codec) -> frame, `prepared` keeps the data objects alive so the ids stay unique
+        frames = {}
+
+        for ws, data in prepared:
+            queue = self.handlers.get(ws)
+
+            if queue is None:
+                continue
+
+            if not isinstance(data, (str, bytes)):
+                frame_key = (id(data), ws.codec)
+                frame = frames.get(frame_key)
+
+                if frame is None:
+                    frame = frames[frame_key] = ws.codec.encode(data)
+
+                data = frame
+
+            queue.put(data, key)
+
+    def get_stats(self):
+        """ Get the metrics of this process
+
+        :return: dict with the number of connections, queued frames, the most frames any open connection has had
+                 queued, frames dropped, connections closed because of slow consumers, messages waiting to be
+                 prepared and connections closed because they stopped answering pings
+        """
+        queues = list(self.handlers.values())
+
+        return {
+            'connections': len(queues),
+            'queued': sum(len(queue) for queue in queues),
+            'max_depth': max([queue.max_depth for queue in queues] or [0]),
+            'dropped': self.dropped + sum(queue.dropped for queue in queues),
+            'coalesced': sum(queue.coalesced for queue in queues),
+            'disconnected': self.disconnected,
+            'pending': self.pending.qsize(),
+            'dead_peers': get_heartbeat().dead,
+        }
+
+    async def log_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+
+            logger.info("Stats: %s", ', '.join('%s=%s' % item for item in sorted(self.get_stats().items())))
+
+    def connect(self):
+        # Connecting blocks for up to the connect timeout, so it is done in a thread instead of the event loop
+        future = self.loop.run_in_executor(None, self.create_subscription)
+        future.add_done_callback(self.on_connected)
+
+    def create_subscription(self):
+        """ Connect to Redis and subscribe to the channels, runs in a thread
+
+        :return: SubscriberPubSub or None if Redis isn't available
+        """
+        r = pubsub.create_redis_connection()
+
+        if r is None:
+            return None
+
+        subscription = SubscriberPubSub(r.connection_pool)
+
+        try:
+            subscription.subscribe(*self.channels)
+
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning("Failed to subscribe: %s", e)
+
+            try:
+                subscription.close()
+
+            except redis.exceptions.RedisError:
+                pass
+
+            return None
+
+        return subscription
+
+    def on_connected(self, future):
+        try:
+            self.pubsub = future.result()
+
+        except Exception as e:
+            logger.warning("Failed to subscribe: %s", e)
+            self.pubsub = None
+
+        if self.pubsub is None:
+            self.reconnect()
+            return
+
+        self.backoff.succeeded()
+        self.update_reader()
+
+        logger.debug("Subscribed to Redis channels: %s", ', '.join(self.channels))
+
+    def update_reader(self):
+        """ Make the event loop watch the current socket of the subscription (if any).
+
+            Sockets are compared by identity, a new socket can get the fd number of the closed one.
+        """
+        sock = None
+
+        if self.pubsub is not None and self.pubsub.connection is not None and not self.paused:
+            sock = self.pubsub.connection._sock
+
+        if sock is self.sock:
+            return
+
+        if self.fileno is not None:
+            self.loop.remove_reader(self.fileno)
+
+        self.sock = sock
+        self.fileno = None
+
+        if sock is not None:
+            self.fileno = sock.fileno()
+            self.loop.add_reader(self.fileno, self.read)
+
+    def disconnect(self):
+        pubsub, self.pubsub = self.pubsub, None
+
+        # Stop watching the socket before it is closed
+        self.update_reader()
+
+        if pubsub is not None:
+            try:
+                pubsub.close()
+
+            except redis.exceptions.RedisError:
+                pass
+
+    def read(self):
+        """ Called by the event loop when the Redis socket is readable.
+
+            Drains everything that has been buffered so far, get_message only blocks
+            for the remainder of a partially received reply.
+        """
+        if self.pubsub is None:
+            return
+
+        try:
+            while True:
+                if self.pending.full():
+                    self.pause()
+                    break
+
+                msg = self.pubsub.get_message()
+
+                # Just in case the connection was replaced while reading
+                self.update_reader()
+
+                if msg is None:
+                    break
+
+                if msg['type'] != 'message':
+                    continue
+
+                logger.debug("Got update from Redis: %s", msg)
+                self.dispatch(msg)
+
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning("Lost connection to Redis: %s", e)
+
+            self.disconnect()
+            self.reconnect()
+
+    def pause(self):
+        logger.debug("Too many messages waiting to be prepared, pausing reading from Redis")
+
+        self.paused = True
+        self.update_reader()
+
+    def resume(self):
+        logger.debug("Resuming reading from Redis")
+
+        self.paused = False
+        self.update_reader()
+
+        # Messages may already be buffered by redis-py, in which case the socket is not readable
+        self.loop.call_soon(self.read)
+
+    def reconnect(self):
+        self.backoff.failed()
+
+        logger.info("Reconnecting to Redis in %.1f seconds", self.backoff.delay)
+        self.loop.call_later(self.backoff.delay, self.connect)
+
+
+_subscriber = None
+_subscriber_pid = None
+
+
+def get_subscriber():
+    """ Get the subscriber of the current process (every forked worker gets its own)
+    """
+    global _subscriber, _subscriber_pid
+
+    if _subscriber is None or _subscriber_pid != os.getpid():
+        _subscriber = Subscriber()
+        _subscriber_pid = os.getpid()
+
+    return _subscriber
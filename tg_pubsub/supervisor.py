@@ -0,0 +1,203 @@
+import logging
+import math
+import os
+import signal
+import socket
+import time
+
+from django.db import connections
+
+from .config import get_pubsub_server_shutdown_timeout
+from .pubsub import Backoff
+
+
+logger = logging.getLogger('tg_pubsub.server')
+
+
+class Supervisor(object):
+    """ Runs the pubsub server in `workers` forked processes that all accept connections from the
+        listening sockets bound by the supervisor. Every worker has its own event loop, Redis subscriber
+        and database executor.
+
+        Workers that exit are restarted (with backoff if they keep dying right after starting). On SIGTERM or
+        SIGINT the workers are told to shut down gracefully (see worker.run_pubsub_server) and the supervisor
+        exits once all of them have. Workers still running `KILL_GRACE` seconds after their shutdown timeout
+        are killed.
+    """
+
+    # Workers that ran for less than this many seconds count as crashed on startup
+    MIN_UPTIME = 10
+
+    BACKLOG = 1024
+
+    # Seconds to wait on top of the shutdown timeout before killing workers that did not stop
+    KILL_GRACE = 5
+
+    SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(self, host, port, workers, event_loop):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.event_loop = event_loop
+
+        self.sockets = []
+        self.stopping = False
+        self.backoff = Backoff(base=0.5, maximum=30)
+
+        # pid -> start time of the worker
+        self.children = {}
+
+    def bind(self):
+        """ Bind a listening socket for every address the host resolves to, like loop.create_server does
+
+        :return: List of sockets
+        """
+        # An empty host means all interfaces
+        host = self.host or None
+
+        addrinfos = []
+
+        for addrinfo in socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE):
+            if addrinfo not in addrinfos:
+                addrinfos.append(addrinfo)
+
+        sockets = []
+
+        try:
+            for family, type_, proto, canonname, address in addrinfos:
+                sock = socket.socket(family, type_, proto)
+                sockets.append(sock)
+
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+                if family == getattr(socket, 'AF_INET6', None) and hasattr(socket, 'IPPROTO_IPV6'):
+                    # Otherwise the IPv6 socket also takes the IPv4 port and binding the IPv4 address fails
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+
+                sock.bind(address)
+                sock.listen(self.BACKLOG)
+                sock.setblocking(False)
+
+        except Exception:
+            for sock in sockets:
+                sock.close()
+
+            raise
+
+        return sockets
+
+    def run(self):
+        logger.info("Starting pubsub server on %s:%d with %d workers", self.host, self.port, self.workers)
+
+        self.sockets = self.bind()
+
+        # Workers must not share the database connections of the supervisor
+        for connection in connections.all():
+            connection.close()
+
+        for signum in self.SIGNALS:
+            signal.signal(signum, self.stop)
+
+        for i in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+
+            except InterruptedError:
+                continue
+
+            except ChildProcessError:
+                break
+
+            self.on_exit(pid, status)
+
+        for sock in self.sockets:
+            sock.close()
+
+        logger.info("Pubsub server stopped")
+
+    def on_exit(self, pid, status):
+        """ Restart a worker that exited, with backoff if it crashed right after starting
+        """
+        started = self.children.pop(pid, None)
+
+        if started is None or self.stopping:
+            return
+
+        logger.warning("Worker %d exited with status %d", pid, status)
+
+        if time.monotonic() - started < self.MIN_UPTIME:
+            self.backoff.failed()
+            time.sleep(self.backoff.delay)
+
+        else:
+            self.backoff.succeeded()
+
+        if not self.stopping:
+            self.spawn()
+
+    def spawn(self):
+        # Signals are blocked until the worker has replaced the handlers of the supervisor
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.SIGNALS)
+
+        pid = os.fork()
+
+        if pid:
+            self.children[pid] = time.monotonic()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+            return
+
+        # Worker process, never returns to the caller
+        code = 0
+
+        try:
+            self.children = {}
+
+            for signum in self.SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+
+            from .worker import run_pubsub_server
+
+            run_pubsub_server(self.host, self.port, workers=1, sockets=self.sockets, event_loop=self.event_loop)
+
+        except Exception:
+            logger.exception("Pubsub server worker %d failed", os.getpid())
+            code = 1
+
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+
+        self.stopping = True
+
+        logger.info("Stopping %d workers", len(self.children))
+
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+
+            except ProcessLookupError:
+                pass
+
+        # Workers that hang while shutting down would otherwise keep the supervisor waiting forever
+        signal.signal(signal.SIGALRM, self.kill)
+        signal.alarm(int(math.ceil(get_pubsub_server_shutdown_timeout() + self.KILL_GRACE)))
+
+    def kill(self, signum, frame):
+        for pid in self.children:
+            logger.warning("Worker %d did not stop in time, killing it", pid)
+
+            try:
+                os.kill(pid, signal.SIGKILL)
+
+            except ProcessLookupError:
+                pass
@@ -1,28 +1,37 @@
 import asyncio
-import json
 import logging
-import time
+import os
+import signal
 
-import websockets
-
-from django.utils.encoding import force_text
-from rest_framework.utils import encoders
+from urllib.parse import parse_qs, urlparse
 
-from .exceptions import InvalidMessageException, IgnoreMessageException
+import websockets
 
-from . import pubsub
+from django.core.exceptions import ImproperlyConfigured
 
-from .config import get_protocol_handler_klass, get_hello_packets, get_pubsub_server_ping_delta
-from .messages import registry
+from .cache import TTLCache
+from .codecs import get_codec
+from .config import (
+    get_batch_interval, get_batch_size, get_codec_param, get_hello_packet_factories, get_hello_packets,
+    get_hello_packets_ttl, get_protocol_handler_klass, get_pubsub_server_event_loop,
+    get_pubsub_server_shutdown_timeout, get_pubsub_server_workers, get_slow_consumer_close_code,
+    get_websocket_codec, get_websocket_codecs,
+)
+from .exceptions import IgnoreMessageException
+from .executor import run_db_job
+from .heartbeat import get_heartbeat
+from .messages import decode_message
+from .subscriber import get_subscriber
 
 
 logger = logging.getLogger('tg_pubsub.server')
 
 
 class HandlerProtocol(object):
-    def __init__(self, ws, request):
+    def __init__(self, ws, request, codec=None):
         self.socket = ws
         self.request = request
+        self.codec = codec or get_codec(get_websocket_codec())
 
         assert self.socket is not None
 
@@ -38,129 +47,391 @@ class HandlerProtocol(object):
 
         return self.request.user
 
+    def load_user(self):
+        """ Resolve the lazy request user. This hits the session store and the database so
+            it should be run via the executor.
+        """
+        return self.user.pk
+
+    def check_permissions(self):
+        """ Resolve the lazy request user and check the permissions of the protocol (see
+            protocol.RequestServerProtocol.has_permissions). Should be run via the executor.
+        """
+        self.load_user()
+
+        has_permissions = getattr(self.socket, 'has_permissions', None)
+
+        return has_permissions is None or has_permissions(self.request)
+
+    @property
+    def permission_denied_close_code(self):
+        return getattr(self.socket, 'PERMISSION_DENIED_CLOSE_CODE', 1008)
+
     @property
     def logging_key(self):
         return 'tg_pubsub.handler-%s' % (self.user.pk or 'none')
 
-    @asyncio.coroutine
-    def ping(self):
-        yield from self.socket.ping()
+    async def ping(self):
+        """ Send a ping
+
+        :return: Future completed when the pong is received
+        """
+        return await self.socket.ping()
 
-    @asyncio.coroutine
-    def send(self, data):
+    async def close(self, code=1000, reason=''):
+        await self.socket.close(code, reason)
+
+    async def recv(self):
+        return await self.socket.recv()
+
+    async def send(self, data):
         if isinstance(data, dict):
-            data = json.dumps(data, cls=encoders.JSONEncoder)
+            data = self.codec.encode(data)
+
+        await self.socket.send(data)
 
-        yield from self.socket.send(data)
+
+class HelloPackets(object):
+    """ Hello packets shared by all the connections of the process.
+
+        If TG_PUBSUB_HELLO_PACKETS_TTL is set, the packets and their encoded frames are reused for that many
+        seconds and connections arriving while the packets are being created wait for the same result.
+    """
+
+    CACHE_KEY = 'hello'
+
+    def __init__(self):
+        self.cache = None
+        self.loading = None
+
+    async def get(self):
+        """ Get the hello packets
+
+        :return: (packets, frames) tuple, frames is a dict for caching the encoded frames of the packets
+        """
+        ttl = get_hello_packets_ttl()
+
+        if not ttl:
+            # Hello packet factories are often backed by the database
+            packets = await run_db_job(get_hello_packets)
+            return packets, {}
+
+        if self.cache is None:
+            self.cache = TTLCache(1, ttl)
+
+        entry = self.cache.get(self.CACHE_KEY)
+
+        if entry is None:
+            if self.loading is None:
+                self.loading = asyncio.get_event_loop().create_task(self.load())
+
+            # Shielded so a client disconnecting does not cancel the load for everyone else
+            entry = await asyncio.shield(self.loading)
+
+        return entry
+
+    async def load(self):
+        try:
+            packets = await run_db_job(get_hello_packets)
+
+            entry = (packets, {})
+            self.cache.set(self.CACHE_KEY, entry)
+
+            return entry
+
+        finally:
+            self.loading = None
+
+
+hello_packets = HelloPackets()
 
 
 class WebSocketHandler(object):
-    def __init__(self, ws, request):
+    def __init__(self, ws, request, codec=None):
         super().__init__()
 
-        self.ws = HandlerProtocol(ws, request)
+        self.ws = HandlerProtocol(ws, request, codec=codec)
+        self.logger = logger
+
+    async def run(self):
+        allowed = await run_db_job(self.ws.check_permissions)
         self.logger = logging.getLogger(self.ws.logging_key)
 
-    @asyncio.coroutine
-    def run(self):
-        yield from self.send_hello()
-        yield from self.send_on_change()
+        if not allowed:
+            self.logger.info("Closing connection, permission denied")
+            await self.ws.close(self.ws.permission_denied_close_code, 'Permission denied')
+            return
+
+        await self.send_hello()
+        await self.send_on_change()
+
+    async def ping(self):
+        return await self.ws.ping()
+
+    async def prepare_for_send(self, message_class, data):
+        if message_class.prepare_in_executor:
+            return await run_db_job(message_class.prepare_for_send, self.ws, data)
+
+        return message_class.prepare_for_send(self.ws, data)
 
-    @asyncio.coroutine
-    def ping(self):
-        yield from self.ws.ping()
+    async def send_hello(self):
+        packets, frames = await hello_packets.get()
 
-    @asyncio.coroutine
-    def send_hello(self):
-        packets = get_hello_packets()
+        if not packets:
+            return
 
         self.logger.debug("Sending %d hello packets", len(packets))
 
-        for packet in packets:
-            yield from self.ws.send(packet.prepare_for_send(self.ws, packet.data))
+        codec = self.ws.codec
+        encoded = []
 
-        self.logger.debug("Sent %d hello packets", len(packets))
+        for index, packet in enumerate(packets):
+            try:
+                data = await self.prepare_for_send(packet.__class__, packet.data)
 
-    @asyncio.coroutine
-    def send_on_change(self):
-        # Create Redis connection, subscribe channels
-        self.logger.debug("Entering main Redis loop")
-        r = pubsub.create_redis_connection()
-        p = r.pubsub()
+            except IgnoreMessageException:
+                continue
 
-        # Subscribe to django channel.
-        p.subscribe('django')
+            if data is packet.data:
+                # Not customized for this client, so the frame can be shared
+                key = (index, codec.name)
 
-        last = None
+                if key not in frames:
+                    frames[key] = codec.encode(data)
 
-        should_ping = get_pubsub_server_ping_delta()
+                encoded.append(frames[key])
 
-        while self.ws.open:
-            now = time.time()
+            else:
+                encoded.append(codec.encode(data))
 
-            if should_ping:
-                if last is None or last < now - should_ping:
-                    self.logger.debug('send ping: last: %s, current_time: %s', last, now)
-                    last = now
-                    yield from self.ping()
+        if encoded and get_batch_interval():
+            # Clients of a batching server already expect array frames
+            await self.ws.send(codec.encode_batch(encoded))
 
-            msg = p.get_message(ignore_subscribe_messages=True)
-            if msg is None:
-                # If there was no message, sleep for one second, and try again
-                yield from asyncio.sleep(1.0)
-                continue
+        else:
+            for frame in encoded:
+                await self.ws.send(frame)
 
-            try:
-                self.logger.debug("Got update from Redis: %s", msg)
-                identifier, data = self.message_valid(msg)
+        self.logger.debug("Sent %d hello packets", len(encoded))
 
-            except InvalidMessageException:
-                continue
+    async def send_on_change(self):
+        # Register with the process-wide Redis subscriber
+        subscriber = get_subscriber()
+        queue = subscriber.register(self.ws)
 
-            else:
-                try:
-                    yield from self.ws.send(identifier.prepare_for_send(self.ws, data))
+        receiver = asyncio.get_event_loop().create_task(self.receive(queue))
+
+        # Pings are sent by the process-wide heartbeat
+        heartbeat = get_heartbeat()
+        heartbeat.add(self.ws)
+
+        batch_interval = get_batch_interval()
+
+        try:
+            while self.ws.open:
+                data = await queue.get()
+
+                if data is None:
+                    break
 
-                except IgnoreMessageException as e:
-                    self.logger.debug('%s' % e)
+                if batch_interval:
+                    data = await self.collect_batch(queue, data, batch_interval, get_batch_size())
+
+                await self.ws.send(data)
+
+            if queue.overflowed:
+                self.logger.info("Closing connection, client is not reading fast enough")
+                await self.ws.close(get_slow_consumer_close_code(), 'Too slow')
+
+        finally:
+            receiver.cancel()
+            heartbeat.remove(self.ws)
+            subscriber.unregister(self.ws)
+
+    async def collect_batch(self, queue, frame, interval, max_size):
+        """ Wait for more frames to arrive (unless there are enough already) and combine them into a single
+            frame containing an array of messages.
+        """
+        if len(queue) < max_size - 1:
+            await asyncio.sleep(interval)
+
+        return self.ws.codec.encode_batch([frame] + queue.get_many(max_size - 1))
+
+    async def receive(self, queue):
+        try:
+            while True:
+                message = await self.ws.recv()
+
+                if message is None:
+                    return
+
+                self.on_client_message(message)
+
+        finally:
+            # Connection was closed (or receiving failed), wake up the send loop since nothing else will
+            queue.close()
+
+    def on_client_message(self, message):
+        """ Handle a message sent by the client, supported messages are:
+
+            {"type": "subscribe", "channels": ["app_label.ModelName", "app_label.ModelName:pk", ...]}
+            {"type": "unsubscribe", "channels": ["app_label.ModelName", "app_label.ModelName:pk", ...]}
+
+            Text frames are always json, binary frames are decoded with the codec of the connection.
+        """
+        codec = self.ws.codec if isinstance(message, bytes) and self.ws.codec.binary else get_codec('json')
+
+        try:
+            message = codec.decode(message)
+            action, channels = message['type'], message['channels']
+
+        except (ValueError, KeyError, TypeError):
+            self.logger.debug("Ignoring invalid client message: %s", message)
+            return
+
+        if not isinstance(channels, list) or not all(isinstance(channel, str) for channel in channels):
+            self.logger.debug("Ignoring invalid client message: %s", message)
+            return
+
+        if action == 'subscribe':
+            get_subscriber().subscribe(self.ws, channels)
+
+        elif action == 'unsubscribe':
+            get_subscriber().unsubscribe(self.ws, channels)
+
+        else:
+            self.logger.debug("Ignoring unknown client message: %s", message)
 
     @classmethod
     def message_valid(cls, message):
-        msg_data = force_text(message['data'])
+        return decode_message(message)
+
+
+def get_client_codec(path):
+    """ Get the codec requested by the client via the codec query parameter (e.g. ?codec=msgpack), the
+        codec must be listed in TG_PUBSUB_WEBSOCKET_CODECS.
+
+    :return: Codec or None to use the default
+    """
+    name = parse_qs(urlparse(path).query).get(get_codec_param(), [''])[0]
+
+    if not name or name not in get_websocket_codecs():
+        return None
 
-        if not msg_data or ':' not in msg_data:
-            raise InvalidMessageException()
+    try:
+        return get_codec(name)
 
-        identifier, data = force_text(msg_data).split(':', 1)
+    except ImproperlyConfigured as e:
+        logger.warning("Client requested unavailable codec %s: %s", name, e)
+        return None
 
-        if not (identifier and data):
-            raise InvalidMessageException()
 
-        # Only accept valid identifiers
-        if identifier not in registry.keys():
-            raise InvalidMessageException()
+async def client_handler(ws, path, request=None):
+    handler = WebSocketHandler(ws, request, codec=get_client_codec(path))
 
-        # Parse the message body
+    await handler.run()
+
+
+async def shutdown_pubsub_server(servers, timeout):
+    """ Stop accepting new connections and close the open ones, giving clients up to `timeout` seconds to
+        acknowledge the close before the process exits.
+    """
+    for server in servers:
+        server.close()
+
+    get_heartbeat().stop()
+
+    closing = [
+        asyncio.ensure_future(ws.close(1001, 'Server shutting down'))
+        for ws in list(get_subscriber().handlers) if ws.open
+    ]
+
+    logger.info("Closing %d connections", len(closing))
+
+    if closing:
+        await asyncio.wait(closing, timeout=timeout)
+
+
+EVENT_LOOP_ASYNCIO = 'asyncio'
+EVENT_LOOP_UVLOOP = 'uvloop'
+
+EVENT_LOOP_CHOICES = (EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP)
+
+
+def set_event_loop_policy(event_loop):
+    """ Make new event loops use the given implementation, see TG_PUBSUB_EVENT_LOOP
+    """
+    if event_loop not in EVENT_LOOP_CHOICES:
+        raise ImproperlyConfigured('Event loop must be one of %s' % ', '.join(EVENT_LOOP_CHOICES))
+
+    if event_loop == EVENT_LOOP_UVLOOP:
         try:
-            data = json.loads(data)
+            import uvloop
+
+        except ImportError:
+            raise ImproperlyConfigured('The uvloop event loop requires the uvloop package')
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def run_pubsub_server(host, port, workers=None, sockets=None, event_loop=None):
+    """ Run the pubsub server until SIGTERM or SIGINT is received
+
+    :param workers: Number of worker processes, more than one forks the workers via supervisor.Supervisor
+                    (default: TG_PUBSUB_WORKERS)
+    :param sockets: Already bound sockets to listen on instead of host and port
+    :param event_loop: Event loop implementation, asyncio or uvloop (default: TG_PUBSUB_EVENT_LOOP)
+    """
+    workers = get_pubsub_server_workers() if workers is None else workers
+    event_loop = get_pubsub_server_event_loop() if event_loop is None else event_loop
+
+    # Set before forking, so the workers use the same implementation
+    set_event_loop_policy(event_loop)
+
+    if workers > 1:
+        from .supervisor import Supervisor
+
+        Supervisor(host, port, workers, event_loop).run()
+        return
+
+    if sockets is None:
+        logger.info("Starting pubsub server on %s:%d", host, port)
+        server_addresses = [{'host': host, 'port': port}]
+
+    else:
+        logger.info("Starting pubsub server worker %d", os.getpid())
+        server_addresses = [{'sock': sock} for sock in sockets]
+
+    # Resolve the hello packet factories once instead of on every connection
+    get_hello_packet_factories()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
-        except:
-            raise InvalidMessageException()
+    logger.debug("Using %s event loop", event_loop)
 
-        return registry[identifier], data
+    servers = [
+        loop.run_until_complete(
+            websockets.serve(client_handler, klass=get_protocol_handler_klass(), **server_address)
+        )
+        for server_address in server_addresses
+    ]
 
+    # Connect to Redis right away instead of waiting for the first client
+    get_subscriber().start()
 
-@asyncio.coroutine
-def client_handler(ws, path, request=None):
-    handler = WebSocketHandler(ws, request)
+    stopping = []
 
-    yield from handler.run()
+    def stop():
+        if not stopping:
+            stopping.append(True)
+            loop.stop()
 
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
 
-def run_pubsub_server(host, port):
-    logger.info("Starting pubsub server on %s:%d", host, port)
+    loop.run_forever()
 
-    start_server = websockets.serve(client_handler, host, port, klass=get_protocol_handler_klass())
+    logger.info("Shutting down pubsub server")
 
-    asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
+    loop.run_until_complete(shutdown_pubsub_server(servers, get_pubsub_server_shutdown_timeout()))